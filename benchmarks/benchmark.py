@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+"""Бенчмарк экспортера на синтетических выгрузках DeepSeek
+
+Генерирует conversations.json заданной формы (число чатов, глубина,
+ветвление, длина сообщений, доля блоков кода и таблиц), замеряет время
+этапов экспорта (без загрузки чатов и вложенных этапов) и пиковое
+потребление памяти (RSS) процесса каждого этапа и сохраняет результат
+в JSON, чтобы сравнивать прогоны между коммитами:
+
+    python benchmarks/benchmark.py --chats 500 --depth 12 --output before.json
+    python benchmarks/benchmark.py --chats 500 --depth 12 --compare before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deepseek_export
+
+WORDS = [
+    'функция', 'данные', 'список', 'значение', 'память', 'процесс', 'ветка', 'ответ',
+    'запрос', 'модель', 'строка', 'таблица', 'индекс', 'поток', 'результат', 'ошибка',
+    'function', 'value', 'buffer', 'thread', 'export', 'render', 'parser', 'token',
+    'cache', 'index', 'stream', 'branch', 'node', 'chat', 'markdown', 'html',
+]
+
+CODE_LINES = [
+    'def process(items):',
+    '    result = []',
+    '    for item in items:',
+    '        if item.value > 10 and item.name != "<tmp>":',
+    '            result.append(item)',
+    '    return sorted(result, key=lambda x: x.value)',
+]
+
+
+def random_sentence(rng, words=12):
+    """Предложение со случайной инлайн-разметкой"""
+    parts = [rng.choice(WORDS) for _ in range(words)]
+    marker = rng.random()
+    if marker < 0.15:
+        parts[0] = f'**{parts[0]}**'
+    elif marker < 0.25:
+        parts[1] = f'`{parts[1]}`'
+    elif marker < 0.3:
+        parts[2] = f'*{parts[2]}*'
+    return ' '.join(parts).capitalize() + '.'
+
+
+def random_message(rng, length, code_density, table_density):
+    """Текст сообщения примерно заданной длины с блоками кода и таблицами"""
+    lines = []
+    size = 0
+    
+    while size < length:
+        roll = rng.random()
+        if roll < code_density:
+            block = ['```python'] + CODE_LINES * rng.randint(1, 4) + ['```']
+        elif roll < code_density + table_density:
+            block = ['| Параметр | Значение | Комментарий |', '|:---|---:|:---:|']
+            block += [f'| {rng.choice(WORDS)} | {rng.randint(1, 999)} | {random_sentence(rng, 4)} |'
+                      for _ in range(rng.randint(2, 8))]
+        elif roll < 0.5:
+            block = [f'- {random_sentence(rng, 6)}' for _ in range(rng.randint(2, 5))]
+        elif roll < 0.6:
+            block = [f'### {random_sentence(rng, 4)}']
+        else:
+            block = [random_sentence(rng, rng.randint(8, 20))]
+        
+        lines.extend(block)
+        lines.append('')
+        size += sum(len(line) + 1 for line in block)
+    
+    return '\n'.join(lines).strip()
+
+
+def generate_chat(rng, number, depth, branching, branch_rate, message_length,
+                  code_density, table_density, max_nodes):
+    """Один чат в формате выгрузки DeepSeek (mapping с корнем root)"""
+    mapping = {'root': {'id': 'root', 'parent': None, 'children': []}}
+    stack = [('root', 0)]
+    counter = 0
+    
+    while stack and counter < max_nodes:
+        parent_id, level = stack.pop()
+        if level >= depth:
+            continue
+        
+        alternatives = branching if rng.random() < branch_rate else 1
+        for _ in range(alternatives):
+            if counter >= max_nodes:
+                break
+            counter += 1
+            node_id = str(counter)
+            
+            if level % 2 == 0:
+                fragments = [{'type': 'REQUEST',
+                              'content': random_message(rng, message_length // 4, 0, 0)}]
+            else:
+                fragments = [
+                    {'type': 'THINK', 'content': random_message(rng, message_length // 2, 0, 0)},
+                    {'type': 'RESPONSE',
+                     'content': random_message(rng, message_length, code_density, table_density)},
+                ]
+            
+            mapping[node_id] = {
+                'id': node_id,
+                'parent': parent_id,
+                'children': [],
+                'message': {
+                    'model': 'deepseek-reasoner',
+                    'inserted_at': '2025-01-01T12:00:00+00:00',
+                    'fragments': fragments,
+                },
+            }
+            mapping[parent_id]['children'].append(node_id)
+            stack.append((node_id, level + 1))
+    
+    return {
+        'id': f'synthetic-{number}',
+        'title': f'Синтетический чат #{number}',
+        'inserted_at': '2025-01-01T12:00:00+00:00',
+        'updated_at': '2025-01-01T12:30:00+00:00',
+        'mapping': mapping,
+    }
+
+
+def generate_export(path, chats, seed, **shape):
+    """Запись синтетической выгрузки в path (чаты пишутся по одному)"""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for number in range(1, chats + 1):
+            if number > 1:
+                f.write(',\n')
+            json.dump(generate_chat(rng, number, **shape), f, ensure_ascii=False)
+        f.write(']')
+
+
+def peak_rss_kb():
+    """Пиковый RSS текущего процесса в килобайтах (Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def timed_chats(json_file, clock):
+    """Чаты выгрузки; время их загрузки прибавляется к clock[0]"""
+    chats = iter(deepseek_export.iter_chats(json_file))
+    while True:
+        start = time.perf_counter()
+        chat = next(chats, None)
+        clock[0] += time.perf_counter() - start
+        if chat is None:
+            return
+        yield chat
+
+
+# Функции этапов возвращают (время собственных вызовов этапа, результат):
+# загрузка чатов, нужная каждому этапу, во время остальных этапов не входит
+
+def stage_load(json_file, output_file, jobs, branch_layout):
+    clock = [0.0]
+    count = sum(1 for _ in timed_chats(json_file, clock))
+    return clock[0], count
+
+
+def stage_branches(json_file, output_file, jobs, branch_layout):
+    count = 0
+    seconds = 0.0
+    for chat in deepseek_export.iter_chats(json_file):
+        start = time.perf_counter()
+        count += len(deepseek_export.extract_all_branches(chat))
+        seconds += time.perf_counter() - start
+    return seconds, count
+
+
+def stage_markdown(json_file, output_file, jobs, branch_layout):
+    size = 0
+    seconds = 0.0
+    for chat in deepseek_export.iter_chats(json_file):
+        for node in chat.get('mapping', {}).values():
+            message = node.get('message')
+            if isinstance(message, dict):
+                content = deepseek_export.extract_content_from_fragments(message)
+                start = time.perf_counter()
+                size += len(deepseek_export.format_full_markdown(content))
+                seconds += time.perf_counter() - start
+    return seconds, size
+
+
+def stage_assembly(json_file, output_file, jobs, branch_layout):
+    size = 0
+    seconds = 0.0
+    for i, chat in enumerate(deepseek_export.iter_chats(json_file), 1):
+        start = time.perf_counter()
+        for chunk in deepseek_export.iter_chat_with_accordion(i, chat, branch_layout):
+            size += len(chunk)
+        seconds += time.perf_counter() - start
+    return seconds, size
+
+
+def stage_write(json_file, output_file, jobs, branch_layout):
+    clock = [0.0]
+    start = time.perf_counter()
+    with open(output_file, 'w', encoding='utf-8',
+              buffering=deepseek_export.OUTPUT_BUFFER_SIZE) as f:
+        deepseek_export.write_html_full_markdown(
+            f, timed_chats(json_file, clock), json_file, 'benchmark', 'benchmark',
+            branch_layout=branch_layout, spool_dir=os.path.dirname(output_file), jobs=jobs)
+    return time.perf_counter() - start - clock[0], os.path.getsize(output_file)
+
+
+# Этапы: (имя в отчете, функция, имя счетчика результата, этапы, время
+# которых входит в замер и вычитается). Сборка HTML сама разбирает ветки
+# и Markdown, запись сама собирает HTML (при --jobs 1 - в том же процессе)
+STAGES = [
+    ('load', stage_load, 'chats', ()),
+    ('extract_all_branches', stage_branches, 'branches', ()),
+    ('format_full_markdown', stage_markdown, 'markdown_html_chars', ()),
+    ('html_assembly', stage_assembly, 'chat_html_chars', ('extract_all_branches', 'format_full_markdown')),
+    ('write', stage_write, 'output_bytes', ('html_assembly',)),
+]
+
+
+def run_stage(func, *args):
+    """Этап в процессе-воркере: время, пиковый RSS этого процесса и результат"""
+    seconds, value = func(*args)
+    return seconds, peak_rss_kb(), value
+
+
+def run_stages(json_file, output_file, jobs, branch_layout):
+    """Время и память этапов: загрузка, ветки, Markdown, сборка HTML и запись файла
+    
+    measured_seconds - время вызовов этапа без загрузки чатов, seconds -
+    оно же за вычетом вложенных этапов (baseline), поэтому сумма seconds
+    равна времени записи. Каждый этап идет в новом процессе (spawn), но
+    любой этап загружает все чаты, а сборка и запись повторяют разбор
+    веток и Markdown: peak_rss_kb - пик процесса с учетом этой работы,
+    rss_delta_kb - прирост пика относительно загрузки.
+    """
+    stages = {}
+    counts = {}
+    context = multiprocessing.get_context('spawn')
+    for name, func, count_name, baseline in STAGES:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            measured, rss_kb, value = pool.submit(run_stage, func, json_file, output_file,
+                                                  jobs, branch_layout).result()
+        if name == 'write' and jobs > 1:
+            # Чаты рендерятся в воркерах параллельно с записью - вычитать нечего
+            baseline = ()
+        own = measured - sum(stages[other]['measured_seconds'] for other in baseline)
+        stages[name] = {
+            'seconds': round(max(own, 0.0), 4),
+            'measured_seconds': round(measured, 4),
+            'baseline': list(baseline),
+            'peak_rss_kb': rss_kb,
+            'rss_delta_kb': rss_kb - stages['load']['peak_rss_kb'] if stages else 0,
+        }
+        counts[count_name] = value
+    return stages, counts
+
+
+def git_commit():
+    """Текущий коммит репозитория (если доступен git)"""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result, baseline=None):
+    """Таблица этапов (и сравнение с предыдущим прогоном)
+    
+    сек - время этапа без загрузки чатов и вложенных этапов, замер - без
+    вычета вложенных этапов; пик RSS - процесса этапа (вместе с загрузкой
+    и вложенными этапами), Δ RSS - прирост пика относительно загрузки.
+    """
+    print(f"\n{'Этап':<24}{'сек':>10}{'замер':>10}{'пик RSS, МБ':>13}{'Δ RSS, МБ':>11}"
+          + (f"{'было, сек':>12}{'Δ':>9}" if baseline else ''))
+    for name, stage in result['stages'].items():
+        line = (f"{name:<24}{stage['seconds']:>10.3f}{stage.get('measured_seconds', stage['seconds']):>10.3f}"
+                f"{stage['peak_rss_kb'] / 1024:>13.1f}{stage.get('rss_delta_kb', 0) / 1024:>+11.1f}")
+        if baseline and name in baseline.get('stages', {}):
+            before = baseline['stages'][name]['seconds']
+            delta = (stage['seconds'] - before) / before * 100 if before else 0.0
+            line += f"{before:>12.3f}{delta:>+8.1f}%"
+        print(line)
+    print(f"\nВходной файл: {result['input_bytes']:,} байт, HTML: {result['counts']['output_bytes']:,} байт")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк экспортера на синтетических выгрузках")
+    parser.add_argument('--chats', type=int, default=200, help="число чатов")
+    parser.add_argument('--depth', type=int, default=10, help="максимальная глубина диалога")
+    parser.add_argument('--branching', type=int, default=3, help="число альтернатив в точке ветвления")
+    parser.add_argument('--branch-rate', type=float, default=0.1,
+                        help="вероятность ветвления в узле")
+    parser.add_argument('--message-length', type=int, default=1500,
+                        help="примерная длина ответа в символах")
+    parser.add_argument('--code-density', type=float, default=0.15,
+                        help="доля блоков кода среди блоков ответа")
+    parser.add_argument('--table-density', type=float, default=0.05,
+                        help="доля таблиц среди блоков ответа")
+    parser.add_argument('--max-nodes', type=int, default=2000, help="ограничение узлов на чат")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--jobs', type=int, default=1, help="--jobs для этапа записи")
+    parser.add_argument('--branch-layout', choices=['full', 'shared', 'fork'], default='full')
+    parser.add_argument('--input', help="готовый JSON вместо синтетического")
+    parser.add_argument('--output', help="куда сохранить результат (JSON)")
+    parser.add_argument('--compare', help="результат предыдущего прогона для сравнения")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    shape = {
+        'depth': args.depth,
+        'branching': args.branching,
+        'branch_rate': args.branch_rate,
+        'message_length': args.message_length,
+        'code_density': args.code_density,
+        'table_density': args.table_density,
+        'max_nodes': args.max_nodes,
+    }
+    
+    with tempfile.TemporaryDirectory(prefix='deepseek-bench-') as workdir:
+        json_file = args.input
+        if not json_file:
+            json_file = os.path.join(workdir, 'conversations.json')
+            print(f"⚙️  Генерация {args.chats} чатов...")
+            generate_export(json_file, args.chats, args.seed, **shape)
+        
+        print("⏱️  Замер этапов...")
+        stages, counts = run_stages(json_file, os.path.join(workdir, 'export.html'),
+                                    args.jobs, args.branch_layout)
+        input_bytes = os.path.getsize(json_file)
+    
+    result = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {'chats': args.chats, 'seed': args.seed, 'jobs': args.jobs,
+                   'branch_layout': args.branch_layout, 'input': args.input, **shape},
+        'input_bytes': input_bytes,
+        'stages': stages,
+        'counts': counts,
+        'peak_rss_kb': max(stage['peak_rss_kb'] for stage in stages.values()),
+    }
+    
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    
+    print_report(result, baseline)
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 Результат сохранен: {args.output}")
+    
+    return result
+
+
+if __name__ == '__main__':
+    main()
@@ -6,18 +6,164 @@ import os
 import sys
 import glob
 import time
+import hashlib
+import io
+import shutil
+import tempfile
+import argparse
+import sqlite3
+import uuid
+import cProfile
+import threading
+import functools
+import zlib
+import base64
+import gzip
+import contextlib
+import mmap
+import bisect
 from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from array import array
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+CONFIG_FILE = 'config.json'
+
+DEFAULT_ROLE_DETECTION = {
+    'fragment_types': {'REQUEST': 'user', 'THINK': 'assistant', 'RESPONSE': 'assistant', 'ANSWER': 'assistant'},
+    'user_keywords': ['?', 'помоги', 'расскажи', 'объясни', 'как', 'что', 'почему'],
+    'assistant_keywords': ['хм,', 'нужно', 'стоит', 'важно', 'можно', 'следует'],
+    'scan_chars': 2000,
+    'assistant_models': ['deepseek', 'gpt', 'assistant', 'ai'],
+    'user_models': ['user', 'human'],
+}
+
+# Лимиты разбора одного чата (0 - без ограничения): сообщений в ветке,
+# веток в чате и узлов mapping, просматриваемых при обходе
+DEFAULT_TREE_LIMITS = {
+    'max_depth': 20000,
+    'max_branches': 2000,
+    'max_nodes': 200000,
+}
+
+# Кэш HTML фрагментов Markdown (см. RenderCache): лимит памяти, копия
+# на диске (по умолчанию render_cache.sqlite в output_directory) и ее лимит
+DEFAULT_RENDER_CACHE = {
+    'memory_mb': 64,
+    'disk': False,
+    'disk_mb': 512,
+    'path': None,
+}
+
+DEFAULT_SETTINGS = {
+    'branch_layout': 'full',
+    'output_directory': 'exports',
+    'incremental': False,
+    'search_index': False,
+    'compress_payload': False,
+    'gzip_copy': False,
+    'role_detection': DEFAULT_ROLE_DETECTION,
+    'tree_limits': DEFAULT_TREE_LIMITS,
+    'render_cache': DEFAULT_RENDER_CACHE,
+}
+
+
+def load_config(config_file=CONFIG_FILE):
+    """Чтение секции settings из config.json (текущая папка или папка скрипта)"""
+    settings = dict(DEFAULT_SETTINGS)
+    
+    candidates = [config_file]
+    if not os.path.isabs(config_file):
+        candidates.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), config_file))
+    
+    for path in candidates:
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+                settings.update(config.get('settings', {}))
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"⚠️ Не удалось прочитать {path}: {e}")
+            break
+    
+    return settings
+
+def render_cache_config(settings):
+    """Секция settings.render_cache с умолчаниями и абсолютным путем файла кэша"""
+    config = dict(DEFAULT_RENDER_CACHE, **(settings.get('render_cache') or {}))
+    path = config['path'] or os.path.join(settings['output_directory'], 'render_cache.sqlite')
+    config['path'] = os.path.abspath(path)
+    return config
+
+# Файлы, которые не являются выгрузками чатов
+EXCLUDED_JSON_FILES = ['package.json', 'tsconfig.json', 'node_modules', 'export_summary']
+
+
+def is_export_candidate(path):
+    """Похож ли JSON файл на выгрузку (не конфиг проекта и не сводка запуска)"""
+    return path.lower().endswith('.json') and not any(ex in path.lower() for ex in EXCLUDED_JSON_FILES)
 
 def find_json_files():
     """Поиск JSON файлов в текущей директории"""
     json_files = glob.glob("*.json")
     
-    excluded = ['package.json', 'tsconfig.json', 'node_modules']
-    json_files = [f for f in json_files if not any(ex in f.lower() for ex in excluded)]
+    json_files = [f for f in json_files if is_export_candidate(f)]
     
     return json_files
 
+def discover_json_files(inputs):
+    """Пары (путь, относительное имя) для файлов, папок и glob-шаблонов
+    
+    Папки обходятся рекурсивно, шаблоны раскрываются с поддержкой **.
+    Относительное имя считается от папки, неизменяемой части шаблона
+    или (для отдельных файлов) от общей родительской папки всех отдельных
+    файлов и используется, чтобы результаты одноименных файлов из разных
+    папок не перезаписывали друг друга. Повторы отбрасываются.
+    """
+    found = []
+    seen = set()
+    files = []
+    
+    def add(path, root):
+        key = os.path.abspath(path)
+        if key not in seen:
+            seen.add(key)
+            found.append((path, os.path.relpath(path, root) if root else None))
+            if root is None:
+                files.append(len(found) - 1)
+    
+    for item in inputs:
+        if os.path.isdir(item):
+            for dirpath, dirnames, filenames in os.walk(item):
+                dirnames[:] = sorted(d for d in dirnames if d != 'node_modules' and not d.startswith('.'))
+                for filename in sorted(filenames):
+                    if is_export_candidate(filename):
+                        add(os.path.join(dirpath, filename), item)
+        elif glob.has_magic(item):
+            # Корень шаблона - путь до первого компонента с * ? [
+            root_parts = []
+            for part in item.replace('\\', '/').split('/'):
+                if glob.has_magic(part):
+                    break
+                root_parts.append(part)
+            root = '/'.join(root_parts) or '.'
+            for path in sorted(glob.glob(item, recursive=True)):
+                if os.path.isfile(path) and is_export_candidate(os.path.basename(path)):
+                    add(path, root)
+        else:
+            # Отдельный файл: ошибку (например, отсутствие файла) покажет экспорт
+            add(item, None)
+    
+    if files:
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(found[i][0])) for i in files])
+        for i in files:
+            path = found[i][0]
+            found[i] = (path, os.path.relpath(os.path.abspath(path), root))
+    
+    return found
+
 def select_json_file():
     """Интерактивный выбор JSON файла"""
     json_files = find_json_files()
@@ -78,49 +224,186 @@ def select_json_file():
         except Exception as e:
             print(f"❌ Ошибка: {e}")
 
-def export_with_full_markdown():
-    """Экспорт с полной поддержкой Markdown и ветвлений"""
+OUTPUT_FORMATS = ('html', 'sqlite')
+
+
+def default_output_path(json_file, timestamp, shard_size=0, output_format='html'):
+    """Имя результата по умолчанию: имяфайла_export_дата_время.html (папка для частей)"""
+    base_name = os.path.splitext(json_file)[0]
+    if output_format == 'sqlite':
+        return f"{base_name}_export_{timestamp}.sqlite"
+    if shard_size:
+        return f"{base_name}_export_{timestamp}"
+    return f"{base_name}_export_{timestamp}.html"
+
+def export_file(json_file, output_file=None, output_format='html', jobs=1, incremental=None,
+                shard_size=0, settings=None, executor=None, search_index=None,
+                compress_payload=None, gzip_copy=None, chat_numbers=None):
+    """Неинтерактивный экспорт одного файла; ошибки передаются вызывающему"""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Неизвестный формат: {output_format}")
+    if not os.path.isfile(json_file):
+        raise FileNotFoundError(f"Файл не найден: {json_file}")
+    if settings is None:
+        settings = load_config()
+    configure_rendering(settings['role_detection'], settings['tree_limits'], render_cache_config(settings))
     
-    json_file = select_json_file()
-    if not json_file:
-        return
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if output_file is None:
+        output_file = default_output_path(json_file, timestamp, shard_size, output_format)
+    
+    # Используем timestamp для предотвращения кэширования
+    cache_buster = str(int(time.time()))
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    branch_layout = settings['branch_layout']
+    if search_index is None:
+        search_index = settings['search_index']
+    if compress_payload is None:
+        compress_payload = settings['compress_payload']
+    if gzip_copy is None:
+        gzip_copy = settings['gzip_copy']
+    
+    if incremental is None:
+        incremental = settings['incremental']
+    
+    with ChatSource(json_file) as source:
+        chats = source
+        if chat_numbers:
+            chats = [source.slice(number) for number in chat_numbers]
+        
+        if output_format == 'sqlite':
+            started = time.perf_counter()
+            os.makedirs(output_dir, exist_ok=True)
+            total_chats = write_sqlite_export(output_file, chats, json_file)
+            return {
+                'input': json_file,
+                'output': output_file,
+                'format': output_format,
+                'chats': total_chats,
+                'seconds': time.perf_counter() - started,
+            }
+        
+        manifest = None
+        if incremental:
+            manifest_dir = settings['output_directory']
+            os.makedirs(manifest_dir, exist_ok=True)
+            manifest = RenderManifest(manifest_path(json_file, manifest_dir),
+                                      render_signature(branch_layout, search_index))
+        
+        started = time.perf_counter()
+        
+        try:
+            if shard_size:
+                total_chats = write_sharded_html(output_file, chats, json_file, timestamp,
+                                                 cache_buster, shard_size, branch_layout=branch_layout,
+                                                 jobs=jobs, manifest=manifest, executor=executor,
+                                                 search_index=search_index, compress_payload=compress_payload,
+                                                 gzip_copy=gzip_copy)
+                output_file = os.path.join(output_file, 'index.html')
+            else:
+                os.makedirs(output_dir, exist_ok=True)
+                with open_output(output_file, gzip_copy) as f:
+                    total_chats = write_html_full_markdown(f, chats, json_file, timestamp,
+                                                           cache_buster, branch_layout=branch_layout,
+                                                           spool_dir=output_dir, jobs=jobs, manifest=manifest,
+                                                           executor=executor, search_index=search_index,
+                                                           compress_payload=compress_payload)
+        except BaseException:
+            if manifest is not None:
+                manifest.close()
+            # Недописанный HTML не оставляем, чтобы его не приняли за результат
+            if not shard_size:
+                for path in (output_file, output_file + '.gz'):
+                    if os.path.isfile(path):
+                        os.remove(path)
+            raise
+        
+        result = {
+            'input': json_file,
+            'output': output_file,
+            'format': output_format,
+            'chats': total_chats,
+            'seconds': time.perf_counter() - started,
+            'cache_buster': cache_buster,
+        }
+        if manifest is not None:
+            manifest.finish(prune=not chat_numbers)
+            result.update(manifest=manifest.path, manifest_hits=manifest.hits,
+                          manifest_misses=manifest.misses)
+        if _render_cache is not None:
+            _render_cache.flush(trim=True)
+        return result
+
+def manifest_path(json_file, manifest_dir):
+    """Путь манифеста инкрементального экспорта для json_file
     
-    print(f"\n📖 Загрузка данных из {json_file}...")
+    К имени файла добавляется хэш его абсолютного пути: одноименные
+    выгрузки из разных папок (conversations.json каждого аккаунта) ведут
+    отдельные манифесты и не удаляют записи друг друга.
+    """
+    name = os.path.splitext(os.path.basename(json_file))[0]
+    path_hash = hashlib.blake2b(os.path.abspath(json_file).encode('utf-8'), digest_size=4).hexdigest()
+    return os.path.join(manifest_dir, f"{name}.{path_hash}.manifest.sqlite")
+
+def run_profiled(func, profile=False, profile_top=10, profile_output=None):
+    """Вызов func() с профилем этапов и, при profile_output, статистикой cProfile"""
+    profiler = ExportProfiler() if profile or profile_output else None
+    previous_profiler = set_profiler(profiler)
+    cprofile = cProfile.Profile() if profile_output else None
+    started = time.perf_counter()
     
     try:
-        with open(json_file, 'r', encoding='utf-8') as f:
-            chats = json.load(f)
-    except json.JSONDecodeError as e:
-        print(f"❌ Ошибка чтения JSON файла: {e}")
-        print("Файл поврежден или имеет неверный формат.")
-        return
-    except Exception as e:
-        print(f"❌ Ошибка загрузки файла: {e}")
-        return
+        result = cprofile.runcall(func) if cprofile is not None else func()
+    finally:
+        set_profiler(previous_profiler)
     
-    if not isinstance(chats, list):
-        chats = [chats]
+    if profiler is not None:
+        profiler.print_summary(time.perf_counter() - started, profile_top)
+    if cprofile is not None:
+        cprofile.dump_stats(profile_output)
+        print(f"💾 Статистика cProfile: {profile_output} (python -m pstats {profile_output})")
     
-    print(f"✅ Загружено чатов: {len(chats)}")
+    return result
+
+def export_with_full_markdown(json_file=None, jobs=1, incremental=None, shard_size=0,
+                              profile=False, profile_top=10, profile_output=None, search_index=None,
+                              compress_payload=None, gzip_copy=None, chat_numbers=None):
+    """Интерактивный экспорт с полной поддержкой Markdown и ветвлений
     
-    base_name = os.path.splitext(json_file)[0]
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    output_file = f"{base_name}_export_{timestamp}.html"
+    Без json_file файл выбирается интерактивно, в конце предлагается
+    открыть результат в браузере. jobs > 1 включает параллельный
+    рендеринг чатов в пуле процессов. incremental включает манифест
+    в output_directory, по которому неизмененные чаты не рендерятся
+    заново (по умолчанию - настройка incremental из config.json).
+    shard_size > 0 - экспорт в папку: index.html и файлы по shard_size чатов.
+    chat_numbers - экспортировать только чаты с этими номерами (с 1).
+    profile печатает профиль этапов и profile_top самых медленных чатов;
+    profile_output - файл для статистики cProfile (pstats).
+    """
     
+    if not json_file:
+        json_file = select_json_file()
+    if not json_file:
+        return
+    
+    print(f"\n📖 Потоковое чтение данных из {json_file}...")
     print(f"⚙️  Создание HTML с аккордеоном для веток...")
     
     try:
-        # Используем timestamp для предотвращения кэширования
-        cache_buster = str(int(time.time()))
-        html = create_html_full_markdown(chats, json_file, timestamp, cache_buster)
-        
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(html)
+        result = run_profiled(
+            lambda: export_file(json_file, jobs=jobs, incremental=incremental, shard_size=shard_size,
+                                search_index=search_index, compress_payload=compress_payload,
+                                gzip_copy=gzip_copy, chat_numbers=chat_numbers),
+            profile, profile_top, profile_output)
         
         print(f"\n🎉 Файл успешно создан!")
-        print(f"📄 Имя файла: {output_file}")
-        print(f"📊 Чатов экспортировано: {len(chats)}")
-        print(f"🔄 Cache buster: {cache_buster}")
+        
+        if 'manifest' in result:
+            print(f"♻️  Из манифеста: {result['manifest_hits']}, отрендерено заново: {result['manifest_misses']}")
+            print(f"🗂️  Манифест: {result['manifest']}")
+        print(f"📄 Имя файла: {result['output']}")
+        print(f"📊 Чатов экспортировано: {result['chats']}")
+        print(f"🔄 Cache buster: {result['cache_buster']}")
         
         # Инструкция по очистке кэша
         print("\n🔧 Если не видите изменений в браузере:")
@@ -131,13 +414,734 @@ def export_with_full_markdown():
         print("      - Перезагрузите страницу")
         
         if input("\n📂 Открыть файл сейчас? (y/n): ").lower() == 'y':
-            open_in_browser(output_file)
+            open_in_browser(result['output'])
             
+    except json.JSONDecodeError as e:
+        print(f"❌ Ошибка чтения JSON файла: {e}")
+        print("Файл поврежден или имеет неверный формат.")
     except Exception as e:
         print(f"❌ Ошибка при создании HTML: {e}")
         import traceback
         traceback.print_exc()
 
+# Файлы меньше этого размера в пакетном режиме экспортируются целиком
+# в воркере; большие читаются в основном процессе и рендерятся пачками
+BATCH_SMALL_FILE_SIZE = 8 * 1024 * 1024
+
+
+def export_file_task(json_file, output_file, output_format, incremental, shard_size, settings,
+                     search_index=None, compress_payload=None, gzip_copy=None, chat_numbers=None,
+                     profile=False):
+    """Экспорт небольшого файла целиком (выполняется в процессе-воркере)
+    
+    Ошибка возвращается в сводке, а не исключением, чтобы один
+    поврежденный файл не останавливал пакет.
+    """
+    profiler = ExportProfiler() if profile else None
+    set_profiler(profiler)
+    try:
+        result = export_file(json_file, output_file, output_format, 1, incremental, shard_size, settings,
+                             search_index=search_index, compress_payload=compress_payload,
+                             gzip_copy=gzip_copy, chat_numbers=chat_numbers)
+    except Exception as e:
+        result = {'input': json_file, 'output': output_file, 'error': str(e)}
+    finally:
+        set_profiler(None)
+    return result, profiler.stats() if profiler is not None else None
+
+def export_batch(inputs, output=None, output_format='html', jobs=1, incremental=None,
+                 shard_size=0, quiet=False, summary_file=None, search_index=None,
+                 compress_payload=None, gzip_copy=None, chat_numbers=None):
+    """Пакетный экспорт без вопросов и браузера (cron, CI)
+    
+    inputs - файлы, папки (обходятся рекурсивно) и glob-шаблоны.
+    Настройки читаются и пул процессов создается один раз на весь запуск:
+    файлы меньше BATCH_SMALL_FILE_SIZE уходят в пул целиком (не больше
+    jobs одновременно), а большие в это время рендерятся пачками чатов
+    в том же пуле, поэтому мелкие файлы не простаивают за крупными.
+    output - путь результата для одного файла или папка для нескольких.
+    Сводка запуска пишется в summary_file (для нескольких файлов - по
+    умолчанию export_summary_дата_время.json в папке результатов).
+    Возвращает код завершения: 0 - все файлы экспортированы, 1 - были ошибки.
+    """
+    settings = load_config()
+    json_files = discover_json_files(inputs)
+    if not json_files:
+        print("❌ JSON файлы не найдены", file=sys.stderr)
+        return 1
+    
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    output_is_dir = output is not None and (len(json_files) > 1 or os.path.isdir(output)
+                                            or output.endswith(os.sep))
+    if summary_file is None and len(json_files) > 1:
+        summary_file = os.path.join(output or '.', f"export_summary_{timestamp}.json")
+    
+    results = {}
+    started_at = datetime.now().isoformat(timespec='seconds')
+    started = time.perf_counter()
+    
+    def report(json_file, result):
+        results[json_file] = result
+        if 'error' in result:
+            print(f"❌ {json_file}: {result['error']}", file=sys.stderr)
+        elif not quiet:
+            print(f"✅ {json_file} -> {result['output']} "
+                  f"({result['chats']} чатов, {result['seconds']:.2f} с)")
+    
+    output_files = []
+    for json_file, relative_name in json_files:
+        output_file = output
+        if output_is_dir:
+            output_file = os.path.join(output, default_output_path(relative_name, timestamp, shard_size,
+                                                                   output_format))
+        elif output is None:
+            output_file = default_output_path(json_file, timestamp, shard_size, output_format)
+        output_files.append((json_file, output_file))
+    
+    # Один путь результата у нескольких файлов - второй перезаписал бы первый
+    targets = {}
+    for json_file, output_file in output_files:
+        other = targets.setdefault(os.path.abspath(output_file), json_file)
+        if other != json_file:
+            print(f"❌ {other} и {json_file} записываются в один файл: {output_file}", file=sys.stderr)
+            return 1
+    
+    small_tasks = []
+    large_tasks = []
+    for json_file, output_file in output_files:
+        try:
+            size = os.path.getsize(json_file)
+        except OSError:
+            size = 0
+        if jobs > 1 and size < BATCH_SMALL_FILE_SIZE:
+            small_tasks.append((size, json_file, output_file))
+        else:
+            large_tasks.append((size, json_file, output_file))
+    
+    # Крупные файлы первыми: так пакет быстрее выходит на полную загрузку
+    small_tasks.sort(key=lambda task: -task[0])
+    large_tasks.sort(key=lambda task: -task[0])
+    
+    configure_rendering(settings['role_detection'], settings['tree_limits'], render_cache_config(settings))
+    executor = create_executor(jobs) if jobs > 1 else None
+    small_futures = []
+    feeder = None
+    
+    if small_tasks:
+        slots = threading.BoundedSemaphore(jobs)
+        profile = _profiler is not None
+        
+        def feed():
+            # Не больше jobs мелких файлов в пуле: остальное место - пачкам крупных
+            for _, json_file, output_file in small_tasks:
+                slots.acquire()
+                future = executor.submit(export_file_task, json_file, output_file, output_format,
+                                         incremental, shard_size, settings, search_index,
+                                         compress_payload, gzip_copy, chat_numbers, profile)
+                future.add_done_callback(lambda _: slots.release())
+                small_futures.append((json_file, future))
+        
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+    
+    try:
+        for _, json_file, output_file in large_tasks:
+            try:
+                result = export_file(json_file, output_file, output_format, jobs, incremental,
+                                     shard_size, settings, executor, search_index,
+                                     compress_payload, gzip_copy, chat_numbers)
+            except Exception as e:
+                result = {'input': json_file, 'output': output_file, 'error': str(e)}
+            report(json_file, result)
+        
+        if feeder is not None:
+            feeder.join()
+        for json_file, future in small_futures:
+            result, stats = future.result()
+            if stats is not None:
+                _profiler.merge(stats)
+            report(json_file, result)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    
+    ordered = [results[json_file] for json_file, _ in json_files]
+    failed = sum(1 for result in ordered if 'error' in result)
+    elapsed = time.perf_counter() - started
+    
+    if summary_file:
+        summary = {
+            'started_at': started_at,
+            'seconds': round(elapsed, 3),
+            'jobs': jobs,
+            'format': output_format,
+            'files': len(ordered),
+            'exported': len(ordered) - failed,
+            'failed': failed,
+            'chats': sum(result.get('chats', 0) for result in ordered),
+            'results': ordered,
+        }
+        summary_dir = os.path.dirname(os.path.abspath(summary_file))
+        os.makedirs(summary_dir, exist_ok=True)
+        with open(summary_file, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    
+    if not quiet and len(ordered) > 1:
+        print(f"📊 Файлов: {len(ordered) - failed} из {len(ordered)}, "
+              f"чатов: {sum(result.get('chats', 0) for result in ordered)}, {elapsed:.2f} с")
+        if summary_file:
+            print(f"🧾 Сводка: {summary_file}")
+    
+    return 1 if failed else 0
+
+# Режим --serve: сколько страниц чатов держать отрендеренными, сколько
+# элементов оглавления на странице и сколько записей отдает JSON API за раз
+SERVE_CACHE_CHATS = 128
+SERVE_TOC_PAGE_SIZE = 500
+SERVE_API_MAX_LIMIT = 1000
+SERVE_SEARCH_LIMIT = 100
+
+
+class ChatArchive:
+    """Выгрузка, открытая для просмотра через HTTP (режим --serve)"""
+    
+    def __init__(self, json_file, settings, jobs=1, search=True, cache_size=SERVE_CACHE_CHATS):
+        self.source = ChatSource(json_file)
+        self.source_name = os.path.basename(json_file)
+        self.branch_layout = settings['branch_layout']
+        self.timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        self.export_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+        self.cache_buster = str(int(time.time()))
+        self.toc_items = []
+        self.entries = []
+        self.search_index = SearchIndex() if search else None
+        
+        try:
+            for toc_html, entry, search_data in iter_indexed_chats(self.source, jobs, search=search):
+                self.toc_items.append(toc_html)
+                self.entries.append(entry)
+                if self.search_index is not None:
+                    self.search_index.add_chat(entry['chat'], search_data)
+        except BaseException:
+            self.source.close()
+            raise
+        
+        self.chat_page = functools.lru_cache(maxsize=cache_size)(self._chat_page)
+    
+    def __len__(self):
+        return len(self.entries)
+    
+    def close(self):
+        self.source.close()
+    
+    def index_page(self, page=1):
+        """Страница оглавления с номером page (по SERVE_TOC_PAGE_SIZE чатов), байты UTF-8"""
+        pages = max(1, -(-len(self.entries) // SERVE_TOC_PAGE_SIZE))
+        if not 1 <= page <= pages:
+            raise IndexError(f"Нет страницы оглавления {page} (всего страниц: {pages})")
+        start = (page - 1) * SERVE_TOC_PAGE_SIZE
+        
+        parts = [render_page_head(len(self.entries), self.source_name, self.export_time,
+                                  self.timestamp, self.cache_buster)]
+        if self.search_index is not None:
+            parts.append(SEARCH_BOX)
+        parts.append(TOC_OPEN)
+        parts.extend(self.toc_items[start:start + SERVE_TOC_PAGE_SIZE])
+        parts.append(TOC_CLOSE)
+        if pages > 1:
+            parts.append(render_toc_pager(page, pages))
+        parts.append(render_page_tail(self.cache_buster, shard_size=1,
+                                      search_api='/api/search' if self.search_index is not None else ''))
+        return ''.join(parts).encode('utf-8')
+    
+    def _chat_page(self, number):
+        """Страница одного чата, байты UTF-8 (через кэш - chat_page)"""
+        chat = self.source.slice(number).load()
+        parts = [render_page_head(1, self.source_name, self.export_time, self.timestamp, self.cache_buster),
+                 SHARD_TOC_LINK]
+        parts.extend(iter_chat_with_accordion(number, chat, self.branch_layout))
+        parts.append(render_page_tail(self.cache_buster, toc_href='index.html'))
+        if _render_cache is not None:
+            _render_cache.flush()
+        return ''.join(parts).encode('utf-8')
+    
+    def toc(self, offset=0, limit=SERVE_TOC_PAGE_SIZE):
+        """Часть оглавления для JSON API"""
+        if offset < 0 or limit < 1:
+            raise ValueError("offset не может быть отрицательным, limit должен быть больше 0")
+        limit = min(limit, SERVE_API_MAX_LIMIT)
+        return {
+            'total': len(self.entries),
+            'offset': offset,
+            'chats': self.entries[offset:offset + limit],
+        }
+    
+    def search(self, query, limit=SERVE_SEARCH_LIMIT):
+        """Результаты поиска для JSON API: первые limit сообщений и их общее число"""
+        if self.search_index is None:
+            raise LookupError("Поиск отключен (включается settings.search_index или --search-index)")
+        if limit < 1:
+            raise ValueError("limit должен быть больше 0")
+        found = self.search_index.search(query)
+        results = []
+        for doc in found[:min(limit, SERVE_API_MAX_LIMIT)]:
+            chat, branch, node_id, role, preview = self.search_index.docs[doc]
+            results.append({
+                'chat': chat,
+                'branch': branch,
+                'node': node_id,
+                'role': role,
+                'preview': preview,
+                'title': self.search_index.titles[chat - 1],
+            })
+        return {'query': query, 'total': len(found), 'results': results}
+
+
+class ChatRequestHandler(BaseHTTPRequestHandler):
+    """Запросы режима --serve (выгрузка - self.server.archive)
+    
+    / и /index.html?page=N - оглавление по страницам, /chats_NNNNN.html -
+    страница чата N; JSON API: /api/toc?offset=&limit= и /api/search?q=&limit=.
+    """
+    
+    _CHAT_PATH_RE = re.compile(r'/chats_(\d+)\.html$')
+    
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        archive = self.server.archive
+        
+        try:
+            if url.path in ('/', '/index.html'):
+                self.send_body(archive.index_page(self.int_param(query, 'page', 1)),
+                               'text/html; charset=utf-8')
+            elif url.path == '/api/toc':
+                self.send_json(archive.toc(self.int_param(query, 'offset', 0),
+                                           self.int_param(query, 'limit', SERVE_TOC_PAGE_SIZE)))
+            elif url.path == '/api/search':
+                self.send_json(archive.search(query.get('q', [''])[0],
+                                              self.int_param(query, 'limit', SERVE_SEARCH_LIMIT)))
+            else:
+                match = self._CHAT_PATH_RE.match(url.path)
+                if match is None:
+                    raise LookupError(f"Нет страницы {url.path}")
+                self.send_body(archive.chat_page(int(match.group(1))), 'text/html; charset=utf-8')
+        except ValueError as e:
+            self.send_failure(400, str(e))
+        except LookupError as e:
+            self.send_failure(404, str(e))
+    
+    @staticmethod
+    def int_param(query, name, default):
+        values = query.get(name)
+        if not values:
+            return default
+        try:
+            return int(values[0])
+        except ValueError:
+            raise ValueError(f"Параметр {name} должен быть целым числом") from None
+    
+    def send_body(self, body, content_type, status=200):
+        """Ответ с телом body (байты); сжимается, если клиент принимает gzip"""
+        gzipped = len(body) > 1024 and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = gzip.compress(body, GZIP_COMPRESS_LEVEL)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        self.send_body(body, 'application/json; charset=utf-8', status)
+    
+    def send_failure(self, status, message):
+        # Строка статуса HTTP - только latin-1, поэтому текст ошибки идет в тело
+        if self.path.startswith('/api/'):
+            self.send_json({'error': message}, status)
+        else:
+            self.send_error(status, explain=message)
+    
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def serve(json_file, host='127.0.0.1', port=8000, jobs=1, search_index=None,
+          cache_size=SERVE_CACHE_CHATS, quiet=False):
+    """Просмотр выгрузки через локальный HTTP-сервер вместо готового HTML
+    
+    Чаты индексируются один раз при запуске (ChatArchive), страницы чатов
+    рендерятся по запросу. Работает до Ctrl+C; возвращает код завершения.
+    """
+    if not os.path.isfile(json_file):
+        raise FileNotFoundError(f"Файл не найден: {json_file}")
+    settings = load_config()
+    configure_rendering(settings['role_detection'], settings['tree_limits'], render_cache_config(settings))
+    if search_index is None:
+        search_index = settings['search_index']
+    
+    if not quiet:
+        print(f"📚 Индексация {json_file}...")
+    started = time.perf_counter()
+    archive = ChatArchive(json_file, settings, jobs, search_index, cache_size)
+    
+    try:
+        with ThreadingHTTPServer((host, port), ChatRequestHandler) as server:
+            server.archive = archive
+            server.quiet = quiet
+            if not quiet:
+                print(f"📊 Чатов: {len(archive)}, индексация: {time.perf_counter() - started:.2f} с")
+                print(f"🌐 Откройте http://{host}:{server.server_port}/ (Ctrl+C - остановка)")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                if not quiet:
+                    print("\n👋 Сервер остановлен")
+    finally:
+        archive.close()
+        if _render_cache is not None:
+            _render_cache.flush(trim=True)
+    return 0
+
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+PARALLEL_CHUNK_SIZE = 32
+PAYLOAD_COMPRESS_LEVEL = 6
+GZIP_COMPRESS_LEVEL = 6
+
+# Метка номера чата в кэшируемых фрагментах HTML (уникальна для процесса)
+INDEX_PLACEHOLDER = f'\x00{uuid.uuid4().hex}\x00'
+
+
+class ExportProfiler:
+    """Счетчики этапов экспорта: время, число вызовов и объем результата
+    
+    Этапы вложены (markdown входит в render_chat), поэтому время
+    указывается включительно. Для каждого отрендеренного чата хранится
+    время и размер HTML, чтобы найти самые тяжелые диалоги. Для кэша
+    фрагментов считаются попадания и промахи по видам фрагментов.
+    """
+    
+    def __init__(self):
+        self.stages = {}  # этап -> [секунды, вызовы, байты]
+        self.chats = []   # (номер, заголовок, секунды, байты HTML, узлов)
+        self.caches = {}  # вид фрагмента -> [попадания, промахи]
+    
+    def add(self, stage, seconds, calls=1, size=0):
+        entry = self.stages.get(stage)
+        if entry is None:
+            self.stages[stage] = [seconds, calls, size]
+        else:
+            entry[0] += seconds
+            entry[1] += calls
+            entry[2] += size
+    
+    def add_chat(self, index, title, seconds, size, nodes):
+        self.chats.append((index, title, seconds, size, nodes))
+    
+    def add_cache(self, kind, hits, misses):
+        entry = self.caches.get(kind)
+        if entry is None:
+            self.caches[kind] = [hits, misses]
+        else:
+            entry[0] += hits
+            entry[1] += misses
+    
+    def stats(self):
+        """Данные для передачи из процесса-воркера"""
+        return {'stages': self.stages, 'chats': self.chats, 'caches': self.caches}
+    
+    def merge(self, stats):
+        for stage, (seconds, calls, size) in stats['stages'].items():
+            self.add(stage, seconds, calls, size)
+        for kind, (hits, misses) in stats['caches'].items():
+            self.add_cache(kind, hits, misses)
+        self.chats.extend(stats['chats'])
+    
+    def print_summary(self, total_seconds, top=10):
+        """Сводная таблица этапов и список самых медленных чатов"""
+        print(f"\n📈 Профиль экспорта (всего {total_seconds:.2f} с):")
+        print(f"   {'Этап':<16}{'сек':>10}{'%':>7}{'вызовов':>11}{'байт':>15}")
+        for stage, (seconds, calls, size) in sorted(self.stages.items(), key=lambda item: -item[1][0]):
+            share = seconds / total_seconds * 100 if total_seconds else 0.0
+            print(f"   {stage:<16}{seconds:>10.3f}{share:>7.1f}{calls:>11,}{size:>15,}")
+        
+        if self.caches:
+            print("\n♻️  Кэш фрагментов:")
+            print(f"   {'Фрагменты':<16}{'попаданий':>12}{'промахов':>12}{'%':>7}")
+            for kind, (hits, misses) in sorted(self.caches.items()):
+                rate = hits / (hits + misses) * 100 if hits + misses else 0.0
+                print(f"   {kind:<16}{hits:>12,}{misses:>12,}{rate:>7.1f}")
+        
+        if self.chats and top:
+            print(f"\n🐢 Самые медленные чаты (топ {top}):")
+            slowest = sorted(self.chats, key=lambda chat: -chat[2])[:top]
+            for index, title, seconds, size, nodes in slowest:
+                print(f"   #{index:<7}{seconds:>8.3f} с {size:>12,} байт {nodes:>7,} узлов  {title[:50]}")
+
+
+# Активный профилировщик (None - профилирование выключено)
+_profiler = None
+
+
+def set_profiler(profiler):
+    """Включение профилирования (None - выключить); возвращает предыдущий"""
+    global _profiler
+    previous = _profiler
+    _profiler = profiler
+    return previous
+
+
+# Строка JSON (с экранированными символами) и текст между скобками вне строк
+_JSON_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+_JSON_FLAT = rb'[^\[\]{}"]*(?:' + _JSON_STRING + rb'[^\[\]{}"]*)*'
+
+def nested_value_re(depth):
+    """Шаблон объекта или массива JSON с вложенностью не больше depth
+    
+    re не поддерживает рекурсию, поэтому уровни разворачиваются в шаблон
+    заранее: чат целиком находится одним вызовом match без цикла
+    по скобкам в Python.
+    """
+    pattern = rb'[\[{]' + _JSON_FLAT + rb'[\]}]'
+    for _ in range(depth - 1):
+        pattern = rb'[\[{]' + _JSON_FLAT + rb'(?:' + pattern + _JSON_FLAT + rb')*[\]}]'
+    return re.compile(pattern)
+
+# Чаты DeepSeek вложены на 6 уровней (mapping -> узел -> message -> fragments);
+# более глубокие чаты разбираются медленнее, по одной скобке (_STRUCTURE_RE)
+CHAT_NESTING_DEPTH = 10
+_CHAT_RE = nested_value_re(CHAT_NESTING_DEPTH)
+_STRUCTURE_RE = re.compile(rb'[^"\[\]{}]*(?:' + _JSON_STRING + rb'[^"\[\]{}]*)*([\[\]{}])')
+_VALUE_END_RE = re.compile(rb'[ \t\n\r]*([,\]])')
+_WHITESPACE_RE = re.compile(rb'[ \t\n\r]*')
+_OPEN_BRACKETS = b'[{'
+_UTF8_BOM = b'\xef\xbb\xbf'
+
+# Сколько отображенных файлов держит открытыми процесс-воркер
+MAPPED_SOURCES_LIMIT = 4
+
+
+def scan_error(message, data, pos):
+    """JSONDecodeError с номером строки и столбца для байтового смещения pos"""
+    doc = bytes(data[:pos]).decode('utf-8', 'replace')
+    return json.JSONDecodeError(message, doc, len(doc))
+
+
+class ChatSlice:
+    """Ссылка на чат в файле выгрузки: путь и границы в байтах
+    
+    Декодируется только при load(). В другой процесс передаются лишь
+    путь и границы, воркер декодирует чат из своего отображения файла.
+    """
+    
+    __slots__ = ('path', 'start', 'end', '_source')
+    
+    def __init__(self, path, start, end, source=None):
+        self.path = path
+        self.start = start
+        self.end = end
+        self._source = source
+    
+    def __reduce__(self):
+        return ChatSlice, (self.path, self.start, self.end)
+    
+    def _get_source(self):
+        return self._source if self._source is not None else mapped_source(self.path)
+    
+    def raw(self):
+        """Исходные байты чата"""
+        return self._get_source().data[self.start:self.end]
+    
+    def load(self):
+        """Словарь чата"""
+        return self._get_source().decode(self.start, self.end)
+    
+    def fingerprint(self):
+        """Хэш исходных байтов чата (без декодирования JSON)"""
+        return hashlib.blake2b(self.raw(), digest_size=16).hexdigest()
+
+
+class ChatSource:
+    """Файл выгрузки, отображенный в память (mmap)
+    
+    Границы чатов в массиве верхнего уровня находит байтовый сканер
+    (_STRUCTURE_RE пропускает строки и текст до следующей скобки), сами
+    чаты декодируются по одному и только по запросу. Сканирование идет
+    лениво и запоминается, поэтому slice(n) для чата в начале файла не
+    просматривает остальное. Если в файле не массив, а одиночный объект
+    (как в examples/), он считается единственным чатом.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Пустой файл отобразить нельзя
+            self.data = b''
+        self._starts = array('q')
+        self._ends = array('q')
+        self._scanner = self._scan()
+        self._scanned = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self._file.close()
+    
+    def _scan(self):
+        """Границы чатов (start, end) по мере продвижения по файлу"""
+        data = self.data
+        size = len(data)
+        pos = _WHITESPACE_RE.match(data, len(_UTF8_BOM) if data[:3] == _UTF8_BOM else 0).end()
+        if pos >= size:
+            raise scan_error("Пустой файл", data, pos)
+        
+        if data[pos:pos + 1] != b'[':
+            # Не массив - весь документ как один чат
+            end = size
+            while end > pos and data[end - 1] in b' \t\n\r':
+                end -= 1
+            yield pos, end
+            return
+        
+        pos = _WHITESPACE_RE.match(data, pos + 1).end()
+        if data[pos:pos + 1] == b']':
+            separator = None  # пустой массив
+        else:
+            while True:
+                if pos >= size:
+                    raise scan_error("Незавершенный массив чатов", data, pos)
+                if data[pos] not in _OPEN_BRACKETS:
+                    raise scan_error("Ожидался объект чата", data, pos)
+                match = _CHAT_RE.match(data, pos)
+                end = match.end() if match is not None else self._value_end(pos)
+                yield pos, end
+                
+                separator = _VALUE_END_RE.match(data, end)
+                if separator is None:
+                    if _WHITESPACE_RE.match(data, end).end() >= size:
+                        raise scan_error("Незавершенный массив чатов", data, size)
+                    raise scan_error("Ожидалась ',' или ']'", data, end)
+                if separator.group(1) == b']':
+                    break
+                pos = _WHITESPACE_RE.match(data, separator.end()).end()
+                if data[pos:pos + 1] == b']':
+                    raise scan_error("Лишняя ',' перед ']'", data, pos)
+        
+        rest = _WHITESPACE_RE.match(data, separator.end() if separator else pos + 1).end()
+        if rest < size:
+            raise scan_error("Лишние данные после массива", data, rest)
+    
+    def _value_end(self, start):
+        """Конец объекта, начатого в start, с подсчетом скобок по одной"""
+        data = self.data
+        depth = 0
+        expected = start
+        for match in _STRUCTURE_RE.finditer(data, start):
+            if match.start() != expected:
+                break
+            expected = match.end()
+            depth += 1 if data[match.start(1)] in _OPEN_BRACKETS else -1
+            if depth == 0:
+                return expected
+        raise scan_error("Незавершенный чат", data, expected)
+    
+    def _scan_until(self, count):
+        """Сканирование, пока не найдено count чатов или не кончился файл"""
+        while not self._scanned and len(self._starts) < count:
+            if _profiler is not None:
+                started = time.perf_counter()
+            try:
+                start, end = next(self._scanner)
+            except StopIteration:
+                self._scanned = True
+                break
+            if _profiler is not None:
+                _profiler.add('json_scan', time.perf_counter() - started, 1, end - start)
+            self._starts.append(start)
+            self._ends.append(end)
+    
+    def __len__(self):
+        self._scan_until(sys.maxsize)
+        return len(self._starts)
+    
+    def __iter__(self):
+        """ChatSlice всех чатов по порядку"""
+        n = 0
+        while True:
+            self._scan_until(n + 1)
+            if n >= len(self._starts):
+                return
+            yield ChatSlice(self.path, self._starts[n], self._ends[n], self)
+            n += 1
+    
+    def slice(self, number):
+        """ChatSlice чата с номером number (с 1, как в экспорте)"""
+        if number >= 1:
+            self._scan_until(number)
+        if number < 1 or number > len(self._starts):
+            raise IndexError(f"В файле нет чата #{number} (всего чатов: {len(self)})")
+        return ChatSlice(self.path, self._starts[number - 1], self._ends[number - 1], self)
+    
+    def decode(self, start, end):
+        """Декодирование чата по границам в байтах"""
+        if _profiler is not None:
+            started = time.perf_counter()
+        raw = self.data[start:end]
+        try:
+            chat = json.loads(raw)
+        except json.JSONDecodeError as e:
+            raise scan_error(e.msg, self.data, start + len(e.doc[:e.pos].encode('utf-8'))) from None
+        if _profiler is not None:
+            _profiler.add('json_parse', time.perf_counter() - started, 1, end - start)
+        return chat
+
+
+_mapped_sources = {}
+
+def mapped_source(path):
+    """Отображение файла для декодирования ChatSlice в процессе-воркере
+    
+    Процесс держит открытыми не больше MAPPED_SOURCES_LIMIT файлов,
+    самый давно использованный закрывается первым.
+    """
+    source = _mapped_sources.pop(path, None)
+    if source is None:
+        if len(_mapped_sources) >= MAPPED_SOURCES_LIMIT:
+            _mapped_sources.pop(next(iter(_mapped_sources))).close()
+        source = ChatSource(path)
+    _mapped_sources[path] = source
+    return source
+
+def load_chat(chat):
+    """Словарь чата: ChatSlice декодируется, словарь возвращается как есть"""
+    return chat.load() if isinstance(chat, ChatSlice) else chat
+
+def iter_chats(json_file):
+    """Чаты выгрузки по одному (файл отображается в память, см. ChatSource)
+    
+    Пиковое потребление памяти определяется самым большим чатом,
+    а не размером файла.
+    """
+    with ChatSource(json_file) as source:
+        for chat in source:
+            yield chat.load()
+
+
 def open_in_browser(filename):
     """Открытие файла в браузере"""
     try:
@@ -150,78 +1154,304 @@ def open_in_browser(filename):
         print(f"⚠️ Не удалось открыть в браузере: {e}")
         print(f"   Откройте файл вручную: {filename}")
 
-def extract_all_branches(chat):
-    """Извлечение всех веток из чата"""
-    mapping = chat.get('mapping', {})
-    root = mapping.get('root', {})
-    
-    # Начинаем с детей root
-    start_nodes = root.get('children', [])
-    
-    if not start_nodes:
-        return []
+class MessageNode:
+    """Сообщение дерева диалога: компактная запись вместо словаря
     
-    # Собираем все ветки
-    all_branches = []
+    index - номер сообщения в дереве (ConversationTree.nodes), node_id -
+    исходный ключ mapping. Роль интернируется, поэтому все записи
+    ссылаются на одну из трех строк.
+    """
     
-    for start_node in start_nodes:
-        # Для каждого стартового узла находим все возможные пути
-        branches_from_start = find_all_paths(mapping, start_node)
-        all_branches.extend(branches_from_start)
+    __slots__ = ('index', 'node_id', 'role', 'content')
     
-    # Убираем дубликаты (если ветки пересекаются)
-    unique_branches = []
-    seen = set()
-    
-    for branch in all_branches:
-        # Создаем ключ для сравнения веток
-        branch_key = '|'.join([str(msg.get('node_id', '')) for msg in branch])
-        if branch_key not in seen:
-            seen.add(branch_key)
-            unique_branches.append(branch)
+    def __init__(self, node_id, role, content, index=-1):
+        self.index = index
+        self.node_id = node_id
+        self.role = sys.intern(role)
+        self.content = content
     
-    return unique_branches
+    def __repr__(self):
+        return f'MessageNode({self.node_id!r}, {self.role!r}, {self.content[:30]!r})'
 
-def find_all_paths(mapping, start_node_id):
-    """Нахождение всех возможных путей от начального узла"""
-    if start_node_id not in mapping:
-        return []
-    
-    all_paths = []
+
+class ConversationTree:
+    """Дерево диалога: узлы mapping в массивах с префиксными счетчиками по ролям"""
     
-    # Используем DFS для обхода всех веток
-    stack = [(start_node_id, [])]
+    def __init__(self, mapping, start_node_ids, limits=None):
+        self.nodes = []                 # номер -> MessageNode (только узлы с контентом)
+        self.index_of = {}              # node_id -> номер сообщения
+        self.prev = array('i')          # номер -> предыдущее сообщение на пути (-1 - нет)
+        self.first = array('i')         # номер -> первое сообщение пути
+        self.depth = array('i')         # номер -> длина пути до сообщения включительно
+        self.users = array('i')         # номер -> сообщений пользователя на пути
+        self.assistants = array('i')    # номер -> ответов ассистента на пути
+        self.leaves = []                # последние сообщения веток (-1 - пустая ветка)
+        self.truncated = {}             # сработавшие лимиты: имя -> значение
+        
+        self._build(mapping, start_node_ids, _tree_limits if limits is None else limits)
     
-    while stack:
-        current_id, current_path = stack.pop()
+    def _build(self, mapping, start_node_ids, limits):
+        """Обход mapping в глубину по явному стеку"""
+        max_depth = limits['max_depth']
+        max_branches = limits['max_branches']
+        max_nodes = limits['max_nodes']
         
-        if current_id not in mapping:
-            continue
+        visited = set()
+        seen_leaves = set()
+        processed = 0
         
-        node = mapping[current_id]
+        def add_leaf(last_message):
+            # Ветки с одинаковым последним сообщением совпадают целиком;
+            # False - достигнут лимит веток
+            if last_message in seen_leaves:
+                return True
+            if max_branches and len(self.leaves) >= max_branches:
+                self.truncated['max_branches'] = max_branches
+                return False
+            seen_leaves.add(last_message)
+            self.leaves.append(last_message)
+            return True
         
-        # Извлекаем сообщение из текущего узла
-        message_data = extract_message_with_node_id(node, current_id)
-        if message_data:
-            new_path = current_path + [message_data]
+        for start_node_id in self._node_links(mapping, start_node_ids, visited):
+            # DFS: дети снимаются со стека с конца
+            stack = [(start_node_id, -1)]
+            
+            while stack:
+                if max_nodes and processed >= max_nodes:
+                    # Незавершенные ветки заканчиваются на последнем разобранном сообщении
+                    self.truncated['max_nodes'] = max_nodes
+                    for _, last_message in reversed(stack):
+                        if last_message >= 0 and not add_leaf(last_message):
+                            break
+                    return
+                
+                node_id, last_message = stack.pop()
+                processed += 1
+                node = mapping[node_id]
+                
+                message = extract_message_with_node_id(node, node_id)
+                if message:
+                    if max_depth and last_message >= 0 and self.depth[last_message] >= max_depth:
+                        # Ветка достигла лимита длины - продолжение не разбираем
+                        self.truncated['max_depth'] = max_depth
+                        if not add_leaf(last_message):
+                            return
+                        continue
+                    last_message = self._add_message(message, last_message)
+                
+                children = self._node_links(mapping, node.get('children'), visited)
+                
+                if not children:
+                    if not add_leaf(last_message):
+                        return
+                else:
+                    for child_id in children:
+                        stack.append((child_id, last_message))
+    
+    @staticmethod
+    def _node_links(mapping, node_ids, visited):
+        """Еще не посещенные узлы-словари из списка ссылок; помечаются посещенными"""
+        if not isinstance(node_ids, list):
+            return []
+        links = []
+        for node_id in node_ids:
+            if (isinstance(node_id, str) and node_id not in visited
+                    and isinstance(mapping.get(node_id), dict)):
+                visited.add(node_id)
+                links.append(node_id)
+        return links
+    
+    @classmethod
+    def from_chat(cls, chat):
+        """Построение дерева из чата
+        
+        Обход начинается с детей root; если узла root нет - с узлов,
+        у которых нет родителя в mapping (или родитель - сам узел).
+        """
+        mapping = chat.get('mapping')
+        if not isinstance(mapping, dict):
+            mapping = {}
+        root = mapping.get('root')
+        if isinstance(root, dict):
+            start_node_ids = root.get('children')
         else:
-            new_path = current_path
+            start_node_ids = [node_id for node_id, node in mapping.items()
+                              if isinstance(node, dict) and not (isinstance(node.get('parent'), str)
+                                                                 and node['parent'] in mapping
+                                                                 and node['parent'] != node_id)]
+        
+        if _profiler is None:
+            return cls(mapping, start_node_ids)
         
-        # Получаем детей текущего узла
-        children = node.get('children', [])
+        started = time.perf_counter()
+        tree = cls(mapping, start_node_ids)
+        _profiler.add('tree', time.perf_counter() - started, 1, len(tree.nodes))
+        return tree
+    
+    def _add_message(self, message, prev):
+        index = len(self.nodes)
+        message.index = index
+        self.nodes.append(message)
+        self.index_of[message.node_id] = index
+        self.prev.append(prev)
         
-        if not children:
-            # Дошли до конца ветки
-            all_paths.append(new_path)
+        role = message.role
+        if prev < 0:
+            self.first.append(index)
+            self.depth.append(1)
+            self.users.append(role == 'user')
+            self.assistants.append(role == 'assistant')
         else:
-            # Продолжаем обход для каждого ребенка
-            for child_id in children:
-                stack.append((child_id, new_path.copy()))
+            self.first.append(self.first[prev])
+            self.depth.append(self.depth[prev] + 1)
+            self.users.append(self.users[prev] + (role == 'user'))
+            self.assistants.append(self.assistants[prev] + (role == 'assistant'))
+        return index
+    
+    def message(self, node_id):
+        """Сообщение по node_id (None - узел без контента или вне дерева)"""
+        index = self.index_of.get(node_id)
+        return None if index is None else self.nodes[index]
+    
+    def branches(self):
+        """Все ветки дерева в виде представлений"""
+        return [Branch(self, leaf) for leaf in self.leaves]
+    
+    def path(self, leaf):
+        """Номера сообщений от начала диалога до leaf"""
+        path = []
+        index = leaf
+        prev = self.prev
+        while index >= 0:
+            path.append(index)
+            index = prev[index]
+        path.reverse()
+        return path
+
+
+class Branch:
+    """Ветка диалога: последнее сообщение и цепочка родителей в дереве"""
+    
+    __slots__ = ('tree', 'leaf')
+    
+    def __init__(self, tree, leaf):
+        self.tree = tree
+        self.leaf = leaf
+    
+    def __len__(self):
+        if self.leaf < 0:
+            return 0
+        return self.tree.depth[self.leaf]
+    
+    def __iter__(self):
+        nodes = self.tree.nodes
+        for index in self.tree.path(self.leaf):
+            yield nodes[index]
+    
+    def __getitem__(self, index):
+        if self.leaf < 0:
+            raise IndexError('пустая ветка')
+        nodes = self.tree.nodes
+        if index == 0:
+            return nodes[self.tree.first[self.leaf]]
+        if index == -1:
+            return nodes[self.leaf]
+        return nodes[self.tree.path(self.leaf)[index]]
+    
+    def indices(self):
+        """Номера сообщений ветки по порядку"""
+        if self.leaf < 0:
+            return []
+        return self.tree.path(self.leaf)
+    
+    def node_ids(self):
+        """node_id сообщений ветки по порядку"""
+        nodes = self.tree.nodes
+        return [nodes[index].node_id for index in self.indices()]
+    
+    @property
+    def leaf_id(self):
+        if self.leaf < 0:
+            return None
+        return self.tree.nodes[self.leaf].node_id
+    
+    @property
+    def first_index(self):
+        if self.leaf < 0:
+            return -1
+        return self.tree.first[self.leaf]
+    
+    @property
+    def first_node_id(self):
+        if self.leaf < 0:
+            return None
+        return self.tree.nodes[self.tree.first[self.leaf]].node_id
+    
+    def role_counts(self):
+        """Число сообщений ветки по ролям"""
+        if self.leaf < 0:
+            return {'user': 0, 'assistant': 0, 'unknown': 0}
+        tree = self.tree
+        depth, users, assistants = tree.depth[self.leaf], tree.users[self.leaf], tree.assistants[self.leaf]
+        return {'user': users, 'assistant': assistants, 'unknown': depth - users - assistants}
+
+
+class ChatAnalysis:
+    """Разбор чата, выполняемый один раз для оглавления и тела чата
     
-    return all_paths
+    Дерево, упорядоченные ветки, статистика по ролям, число сообщений
+    и дата создания считаются при создании объекта.
+    """
+    
+    def __init__(self, index, chat):
+        self.index = index
+        self.title = chat.get('title', f'Чат {index}')
+        self.inserted_at = chat.get('inserted_at', '')
+        self.date_str = format_chat_date(self.inserted_at)
+        
+        self.tree = ConversationTree.from_chat(chat)
+        self.branches = organize_branches_by_depth(self.tree.branches())
+        self.branches_count = len(self.branches)
+        self.total_messages = sum(len(branch) for branch in self.branches)
+        
+        # Статистика по ролям (из префиксных счетчиков дерева)
+        self.role_stats = {'user': 0, 'assistant': 0, 'unknown': 0}
+        for branch in self.branches:
+            for role, count in branch.role_counts().items():
+                self.role_stats[role] += count
+        
+        self.truncated = self.tree.truncated
+    
+    def truncation_note(self):
+        """Описание сработавших лимитов дерева ('' - чат разобран полностью)"""
+        return '; '.join(TRUNCATION_NOTES[name].format(limit) for name, limit in self.truncated.items())
+
+
+# Пояснения к сработавшим лимитам settings.tree_limits
+TRUNCATION_NOTES = {
+    'max_depth': 'ветки длиннее {} сообщений обрезаны',
+    'max_branches': 'показаны только первые {} веток',
+    'max_nodes': 'разобраны только первые {} узлов',
+}
+
+
+def format_chat_date(inserted):
+    """Дата чата в виде ДД.ММ.ГГГГ (или исходная строка, если не разобрать)"""
+    if not inserted:
+        return ""
+    try:
+        date_obj = datetime.fromisoformat(inserted.replace('Z', '+00:00'))
+        return date_obj.strftime('%d.%m.%Y')
+    except:
+        return inserted[:10] if len(inserted) >= 10 else inserted
+
+
+def extract_all_branches(chat):
+    """Извлечение всех веток из чата"""
+    return ConversationTree.from_chat(chat).branches()
 
 def extract_message_with_node_id(node, node_id):
-    """Извлечение сообщения с добавлением ID узла"""
+    """Извлечение сообщения (MessageNode) с добавлением ID узла"""
     message = node.get('message', {})
     if not isinstance(message, dict):
         return None
@@ -235,83 +1465,160 @@ def extract_message_with_node_id(node, node_id):
     if not content:
         return None
     
-    return {
-        'node_id': node_id,
-        'role': role,
-        'content': content,
-        'parent': node.get('parent'),
-        'children': node.get('children', [])
-    }
+    return MessageNode(node_id, role, content)
 
-def determine_role(message, node_id, branch_messages=None):
-    """Определение роли для DeepSeek Reasoner (улучшенная версия)"""
-    if not message or not isinstance(message, dict):
-        return 'unknown'
-    
-    # Способ 1: Определяем по fragments.type (ваш случай!)
-    fragments = message.get('fragments', [])
-    if fragments and isinstance(fragments, list) and len(fragments) > 0:
-        first_fragment = fragments[0]
-        if isinstance(first_fragment, dict):
-            fragment_type = first_fragment.get('type', '')
-            if fragment_type == 'REQUEST':
-                return 'user'
-            elif fragment_type in ['THINK', 'RESPONSE', 'ANSWER']:
-                return 'assistant'
+class RoleClassifier:
+    """Определение роли сообщения по настройкам role_detection
     
-    # Способ 2: По содержимому первого фрагмента
-    if fragments and isinstance(fragments, list) and len(fragments) > 0:
-        first_fragment = fragments[0]
-        if isinstance(first_fragment, dict):
-            content = first_fragment.get('content', '')
-            if content:
-                # Проверяем паттерны пользователя
-                content_lower = content.lower()
-                user_patterns = ['?', 'помоги', 'расскажи', 'объясни', 'как', 'что', 'почему']
-                assistant_patterns = ['хм,', 'нужно', 'стоит', 'важно', 'можно', 'следует']
-                
-                user_score = sum(1 for pattern in user_patterns if pattern in content_lower)
-                assistant_score = sum(1 for pattern in assistant_patterns if pattern in content_lower)
+    Порядок проверок: тип первого фрагмента (словарь), ключевые слова
+    в первых scan_chars символах первого фрагмента, model, номер в node_id.
+    Разбор model и node_id кэшируется: значения повторяются от чата к чату.
+    """
+    
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_ROLE_DETECTION, **(config or {}))
+        
+        self.fragment_roles = dict(self.config['fragment_types'])
+        self.scan_chars = int(self.config['scan_chars'])
+        self.user_keywords = tuple(k.lower() for k in self.config['user_keywords'])
+        self.assistant_keywords = tuple(k.lower() for k in self.config['assistant_keywords'])
+        self.assistant_models = tuple(m.lower() for m in self.config['assistant_models'])
+        self.user_models = tuple(m.lower() for m in self.config['user_models'])
+        
+        self.model_role = functools.lru_cache(maxsize=1024)(self._model_role)
+        self.node_id_role = functools.lru_cache(maxsize=65536)(self._node_id_role)
+    
+    def classify(self, message, node_id, branch_messages=None):
+        if not message or not isinstance(message, dict):
+            return 'unknown'
+        
+        fragments = message.get('fragments')
+        if fragments and isinstance(fragments, list):
+            first_fragment = fragments[0]
+            if isinstance(first_fragment, dict):
+                # Способ 1: по типу фрагмента (REQUEST, THINK, RESPONSE...)
+                fragment_type = first_fragment.get('type')
+                if isinstance(fragment_type, str):
+                    role = self.fragment_roles.get(fragment_type)
+                    if role:
+                        return role
                 
-                if user_score > assistant_score:
-                    return 'user'
-                elif assistant_score > user_score:
-                    return 'assistant'
-    
-    # Способ 3: По model (если есть)
-    model = message.get('model', '')
-    if model:
-        model_lower = str(model).lower()
-        if any(x in model_lower for x in ['deepseek', 'gpt', 'assistant', 'ai']):
-            return 'assistant'
-        elif any(x in model_lower for x in ['user', 'human']):
+                # Способ 2: по ключевым словам в начале текста
+                content = first_fragment.get('content')
+                if content and isinstance(content, str):
+                    role = self.keyword_role(content)
+                    if role:
+                        return role
+        
+        # Способ 3: По model (если есть)
+        model = message.get('model')
+        if model:
+            role = self.model_role(str(model))
+            if role:
+                return role
+        
+        # Способ 4: По node_id (чередование)
+        if node_id and node_id != 'root':
+            role = self.node_id_role(str(node_id))
+            if role:
+                return role
+        
+        # Способ 5: Чередование в ветке
+        if branch_messages:
+            last_role = branch_messages[-1].role
+            if last_role == 'user':
+                return 'assistant'
+            elif last_role == 'assistant':
+                return 'user'
+            return 'unknown'
+        
+        # Способ 6: По умолчанию считаем первое сообщение пользователем
+        return 'user'
+    
+    def keyword_role(self, content):
+        """Роль по числу разных ключевых слов пользователя и ассистента"""
+        # Поиск подстрок (in) в CPython быстрее одного регулярного
+        # выражения со всеми словами, поэтому слова проверяются по очереди
+        text = content[:self.scan_chars].lower()
+        user_score = sum(1 for keyword in self.user_keywords if keyword in text)
+        assistant_score = sum(1 for keyword in self.assistant_keywords if keyword in text)
+        if user_score > assistant_score:
             return 'user'
+        elif assistant_score > user_score:
+            return 'assistant'
+        return None
     
-    # Способ 4: По node_id (чередование)
-    if node_id and node_id != 'root':
-        try:
-            import re
-            numbers = re.findall(r'\d+', node_id)
-            if numbers:
-                node_num = int(numbers[-1])
-                # Обычно: нечетные = пользователь, четные = ассистент
-                return 'user' if node_num % 2 == 1 else 'assistant'
-        except:
-            pass
-    
-    # Способ 5: Чередование в ветке
-    if branch_messages and len(branch_messages) > 0:
-        last_role = branch_messages[-1].get('role')
-        if last_role == 'user':
+    def _model_role(self, model):
+        model_lower = model.lower()
+        if any(x in model_lower for x in self.assistant_models):
             return 'assistant'
-        elif last_role == 'assistant':
+        elif any(x in model_lower for x in self.user_models):
             return 'user'
+        return None
     
-    # Способ 6: По умолчанию считаем первое сообщение пользователем
-    if not branch_messages or len(branch_messages) == 0:
-        return 'user'
+    @staticmethod
+    def _node_id_role(node_id):
+        # Обычно: нечетные = пользователь, четные = ассистент
+        match = _LAST_NUMBER_RE.search(node_id)
+        if match is None:
+            return None
+        return 'user' if int(match.group(1)) % 2 == 1 else 'assistant'
+
+
+_LAST_NUMBER_RE = re.compile(r'(\d+)\D*$')
+
+# Активные настройки определения ролей (configure_role_detection)
+_role_classifier = RoleClassifier()
+
+
+def configure_role_detection(config=None):
+    """Настройка определения ролей (секция settings.role_detection)"""
+    global _role_classifier
+    _role_classifier = RoleClassifier(config)
+
+# Активные лимиты разбора чатов (configure_tree_limits)
+_tree_limits = dict(DEFAULT_TREE_LIMITS)
+
+def configure_tree_limits(limits=None):
+    """Настройка лимитов дерева (секция settings.tree_limits)"""
+    global _tree_limits
+    _tree_limits = {key: int(value) for key, value in dict(DEFAULT_TREE_LIMITS, **(limits or {})).items()}
+
+# Активный кэш фрагментов Markdown (None - выключен) и его настройки
+_render_cache = None
+_render_cache_config = None
+
+def configure_render_cache(config=None):
+    """Настройка кэша фрагментов (секция settings.render_cache, см. render_cache_config)
     
-    return 'unknown'
+    При тех же настройках кэш сохраняется, поэтому он общий для всех
+    файлов пакетного запуска, а воркеры пула наследуют его содержимое.
+    """
+    global _render_cache, _render_cache_config
+    config = dict(DEFAULT_RENDER_CACHE, **(config or {}))
+    if config == _render_cache_config:
+        return
+    if _render_cache is not None:
+        _render_cache.close()
+    _render_cache_config = config
+    
+    max_bytes = int(config['memory_mb'] * 1024 * 1024)
+    if config['disk'] and config['path']:
+        _render_cache = RenderCache(max_bytes, config['path'], int(config['disk_mb'] * 1024 * 1024))
+    elif max_bytes > 0:
+        _render_cache = RenderCache(max_bytes)
+    else:
+        _render_cache = None
+
+def configure_rendering(role_detection=None, tree_limits=None, render_cache=None):
+    """Настройки разбора и рендеринга чатов; вызывается и при запуске воркеров пула"""
+    configure_role_detection(role_detection)
+    configure_tree_limits(tree_limits)
+    configure_render_cache(render_cache)
+
+def determine_role(message, node_id, branch_messages=None):
+    """Определение роли для DeepSeek Reasoner (см. RoleClassifier)"""
+    return _role_classifier.classify(message, node_id, branch_messages)
 
 def extract_content_from_fragments(message_data):
     """Извлечение контента из fragments"""
@@ -347,30 +1654,744 @@ def organize_branches_by_depth(branches):
         if not branch:
             continue
         
-        first_msg = branch[0]
-        first_node_id = first_msg.get('node_id', '')
+        first_index = branch.first_index
+        
+        if first_index not in grouped:
+            grouped[first_index] = []
+        
+        grouped[first_index].append(branch)
+    
+    # Сортируем ветки по количеству сообщений (самые длинные первые)
+    result = []
+    for first_index, branch_list in grouped.items():
+        sorted_branches = sorted(branch_list, key=len, reverse=True)
+        result.extend(sorted_branches)
+    
+    return result
+
+def create_html_full_markdown(chats, source_filename, timestamp, cache_buster, branch_layout='full'):
+    """HTML с полной поддержкой Markdown и аккордеоном для веток (одной строкой)"""
+    buffer = io.StringIO()
+    write_html_full_markdown(buffer, chats, source_filename, timestamp, cache_buster, branch_layout)
+    return buffer.getvalue()
+
+class TeeWriter:
+    """Запись одного текстового потока сразу в несколько файлов"""
+    
+    def __init__(self, *streams):
+        self.streams = streams
+    
+    def write(self, text):
+        for stream in self.streams:
+            stream.write(text)
+        return len(text)
+    
+    def seekable(self):
+        return False
+
+
+@contextlib.contextmanager
+def open_output(path, gzip_copy=False):
+    """Файл результата для записи; при gzip_copy рядом пишется path.gz
+    
+    Сжатие идет по мере записи, готовый HTML целиком в памяти не нужен.
+    """
+    with open(path, 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE) as f:
+        if not gzip_copy:
+            yield f
+            return
+        with gzip.open(path + '.gz', 'wt', encoding='utf-8', compresslevel=GZIP_COMPRESS_LEVEL) as gz:
+            yield TeeWriter(f, gz)
+
+def write_deflate_base64(out, chunks):
+    """Сжатие фрагментов (zlib) с выводом в base64 по мере поступления
+    
+    base64 кодирует тройки байтов, поэтому выводится часть, кратная трем,
+    а остаток переносится; результат совпадает с base64 всего потока.
+    Возвращает количество записанных символов.
+    """
+    compressor = zlib.compressobj(PAYLOAD_COMPRESS_LEVEL)
+    pending = b''
+    written = 0
+    for chunk in chunks:
+        pending += compressor.compress(chunk.encode('utf-8'))
+        cut = len(pending) - len(pending) % 3
+        if cut:
+            encoded = base64.b64encode(pending[:cut]).decode('ascii')
+            out.write(encoded)
+            written += len(encoded)
+            pending = pending[cut:]
+    encoded = base64.b64encode(pending + compressor.flush()).decode('ascii')
+    out.write(encoded)
+    return written + len(encoded)
+
+def write_packed_chat(out, index, chunks):
+    """Чат в сжатом виде: заглушка с данными, распаковываемыми в браузере"""
+    out.write(f'''
+    <div class="chat chat-packed" id="chat-{index}" data-chat="{index}"><script type="application/octet-stream" class="chat-payload">''')
+    size = write_deflate_base64(out, chunks)
+    out.write('''</script><div class="chat-packed-note">⏳ Чат распаковывается...</div></div>
+''')
+    return size
+
+
+def write_html_full_markdown(out, chats, source_filename, timestamp, cache_buster,
+                             branch_layout='full', spool_dir=None, jobs=1, manifest=None,
+                             executor=None, search_index=False, compress_payload=False):
+    """Потоковая запись HTML в открытый файл out
+    
+    Один проход по потоку чатов: элементы оглавления и тела чатов пишутся
+    во временные файлы по мере обработки, затем документ собирается
+    копированием блоками. Ни чаты, ни готовый HTML целиком в памяти
+    не держатся. При jobs > 1 чаты рендерятся в пуле процессов, результат
+    побайтно совпадает с последовательным. Манифест (RenderManifest)
+    позволяет не рендерить заново неизмененные чаты. search_index
+    встраивает в страницу поисковый индекс (SearchIndex) и поле поиска.
+    compress_payload хранит чаты и индекс сжатыми (zlib + base64), браузер
+    распаковывает чат при приближении к нему. Возвращает количество чатов.
+    """
+    with tempfile.TemporaryFile('w+', encoding='utf-8', dir=spool_dir) as toc_spool, \
+            tempfile.TemporaryFile('w+', encoding='utf-8', dir=spool_dir) as chats_spool, \
+            (SpooledSearchIndex() if search_index else contextlib.nullcontext()) as index:
+        total_chats = 0
+        
+        for toc_html, chat_chunks, search_data in iter_rendered_chats(
+                chats, branch_layout, jobs, manifest=manifest, executor=executor, search=search_index):
+            total_chats += 1
+            if index is not None:
+                index.add_chat(total_chats, search_data)
+            if _profiler is not None:
+                started = time.perf_counter()
+            toc_spool.write(toc_html)
+            size = len(toc_html)
+            if compress_payload:
+                size += write_packed_chat(chats_spool, total_chats, chat_chunks)
+            else:
+                for chunk in chat_chunks:
+                    chats_spool.write(chunk)
+                    size += len(chunk)
+            if _profiler is not None:
+                _profiler.add('write', time.perf_counter() - started, 1, size)
+        
+        if _profiler is not None:
+            started = time.perf_counter()
+        
+        export_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+        source_name = os.path.basename(source_filename)
+        
+        out.write(render_page_head(total_chats, source_name, export_time, timestamp, cache_buster))
+        if index is not None:
+            out.write(SEARCH_BOX)
+        out.write(TOC_OPEN)
+        
+        toc_spool.seek(0)
+        shutil.copyfileobj(toc_spool, out)
+        
+        out.write(TOC_CLOSE)
+        
+        # Добавляем чаты с ветвлениями
+        chats_spool.seek(0)
+        shutil.copyfileobj(chats_spool, out)
+        
+        if index is not None:
+            index.write(out, compress_payload)
+        out.write(render_page_tail(cache_buster))
+        
+        if _profiler is not None:
+            _profiler.add('assemble', time.perf_counter() - started, 1, out.tell() if out.seekable() else 0)
+    
+    return total_chats
+
+def write_sharded_html(output_dir, chats, source_filename, timestamp, cache_buster, shard_size=1,
+                       branch_layout='full', jobs=1, manifest=None, executor=None, search_index=False,
+                       compress_payload=False, gzip_copy=False):
+    """Экспорт в папку: index.html с оглавлением и файлы частей по shard_size чатов
+    
+    Оглавление строится из тех же данных, что и в однофайловом режиме;
+    браузер загружает часть только при переходе к ее чату, поэтому
+    открытие оглавления не зависит от размера архива. Поисковый индекс
+    (search_index) встраивается в index.html; compress_payload и gzip_copy
+    действуют, как в однофайловом режиме. Возвращает количество чатов.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    export_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S')
+    source_name = os.path.basename(source_filename)
+    
+    shard_spool = None
+    shard_number = 0
+    shard_chats = 0
+    
+    def flush_shard():
+        # Шапка части содержит число чатов, поэтому тело копится во временном файле
+        path = os.path.join(output_dir, f"chats_{shard_number:05d}.html")
+        with open_output(path, gzip_copy) as out:
+            out.write(render_page_head(shard_chats, source_name, export_time, timestamp, cache_buster))
+            out.write(SHARD_TOC_LINK)
+            shard_spool.seek(0)
+            shutil.copyfileobj(shard_spool, out)
+            out.write(render_page_tail(cache_buster, toc_href='index.html'))
+        shard_spool.close()
+    
+    with tempfile.TemporaryFile('w+', encoding='utf-8', dir=output_dir) as toc_spool, \
+            (SpooledSearchIndex() if search_index else contextlib.nullcontext()) as index:
+        total_chats = 0
+        
+        for toc_html, chat_chunks, search_data in iter_rendered_chats(
+                chats, branch_layout, jobs, manifest=manifest, executor=executor, search=search_index):
+            total_chats += 1
+            if index is not None:
+                index.add_chat(total_chats, search_data)
+            toc_spool.write(toc_html)
+            
+            if shard_spool is None:
+                shard_spool = tempfile.TemporaryFile('w+', encoding='utf-8', dir=output_dir)
+                shard_number += 1
+                shard_chats = 0
+            
+            if compress_payload:
+                write_packed_chat(shard_spool, total_chats, chat_chunks)
+            else:
+                for chunk in chat_chunks:
+                    shard_spool.write(chunk)
+            shard_chats += 1
+            
+            if shard_chats >= shard_size:
+                flush_shard()
+                shard_spool = None
+        
+        if shard_spool is not None:
+            flush_shard()
+        
+        index_path = os.path.join(output_dir, 'index.html')
+        with open_output(index_path, gzip_copy) as out:
+            out.write(render_page_head(total_chats, source_name, export_time, timestamp, cache_buster))
+            if index is not None:
+                out.write(SEARCH_BOX)
+            out.write(TOC_OPEN)
+            toc_spool.seek(0)
+            shutil.copyfileobj(toc_spool, out)
+            out.write(TOC_CLOSE)
+            if index is not None:
+                index.write(out, compress_payload)
+            out.write(render_page_tail(cache_buster, shard_size=shard_size))
+    
+    return total_chats
+
+# Размер пачки строк для executemany при записи SQLite
+SQLITE_BATCH_ROWS = 20000
+
+SQLITE_SCHEMA = '''
+CREATE TABLE meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE chats (
+    chat_index INTEGER PRIMARY KEY,
+    chat_id TEXT,
+    title TEXT,
+    inserted_at TEXT,
+    updated_at TEXT,
+    branches INTEGER,
+    messages INTEGER,
+    truncated TEXT
+);
+CREATE TABLE nodes (
+    id INTEGER PRIMARY KEY,
+    chat_index INTEGER NOT NULL REFERENCES chats(chat_index),
+    node_id TEXT NOT NULL,
+    parent_id TEXT,
+    role TEXT,
+    content TEXT,
+    model TEXT,
+    inserted_at TEXT
+);
+CREATE TABLE branches (
+    chat_index INTEGER NOT NULL REFERENCES chats(chat_index),
+    branch_number INTEGER NOT NULL,
+    first_node_id TEXT,
+    leaf_node_id TEXT,
+    length INTEGER,
+    user_messages INTEGER,
+    assistant_messages INTEGER,
+    PRIMARY KEY (chat_index, branch_number)
+);
+'''
+
+SQLITE_INDEXES = '''
+CREATE UNIQUE INDEX nodes_chat_node ON nodes (chat_index, node_id);
+CREATE INDEX nodes_parent ON nodes (chat_index, parent_id);
+'''
+
+
+# Целые, которые SQLite хранит как INTEGER
+SQLITE_MAX_INT = 2 ** 63 - 1
+
+def sqlite_value(value):
+    """Значение поля выгрузки, пригодное для SQLite
+    
+    Строки, числа и None передаются как есть; списки, словари и прочие
+    значения из поврежденной выгрузки записываются текстом JSON, а не
+    останавливают экспорт ошибкой привязки параметра.
+    """
+    if value is None or isinstance(value, (str, float)):
+        return value
+    if isinstance(value, int) and -SQLITE_MAX_INT - 1 <= value <= SQLITE_MAX_INT:
+        return value
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+def sqlite_chat_rows(index, chat):
+    """Строки таблиц chats, nodes и branches для одного чата
+    
+    Узлы повторяют mapping целиком (включая root и узлы без текста),
+    роль и текст берутся из дерева диалога, как в HTML. Ветки
+    нумеруются так же, как в HTML (organize_branches_by_depth).
+    """
+    analysis = ChatAnalysis(index, chat)
+    tree = analysis.tree
+    
+    chat_row = (index, sqlite_value(chat.get('id')), sqlite_value(analysis.title),
+                sqlite_value(analysis.inserted_at), sqlite_value(chat.get('updated_at')),
+                analysis.branches_count, len(tree.nodes), analysis.truncation_note() or None)
+    
+    mapping = chat.get('mapping')
+    node_rows = []
+    for node_id, node in (mapping.items() if isinstance(mapping, dict) else ()):
+        if not isinstance(node, dict):
+            continue
+        message = node.get('message')
+        role = content = model = inserted_at = None
+        if isinstance(message, dict):
+            message_node = tree.message(node_id)
+            if message_node is not None:
+                role = message_node.role
+                content = message_node.content
+            else:
+                role = determine_role(message, node_id)
+                content = extract_content_from_fragments(message)
+            model = sqlite_value(message.get('model'))
+            inserted_at = sqlite_value(message.get('inserted_at'))
+        node_rows.append((index, node_id, sqlite_value(node.get('parent')), role, content, model, inserted_at))
+    
+    branch_rows = []
+    for branch_num, branch in enumerate(analysis.branches, 1):
+        roles = branch.role_counts()
+        branch_rows.append((index, branch_num, branch.first_node_id, branch.leaf_id, len(branch),
+                            roles['user'], roles['assistant']))
+    
+    return chat_row, node_rows, branch_rows
+
+def create_sqlite_fts(db):
+    """Полнотекстовый индекс по nodes.content: FTS5, при его отсутствии FTS4
+    
+    Возвращает использованный модуль или None, если сборка SQLite
+    не поддерживает полнотекстовый поиск.
+    """
+    for module in ('fts5', 'fts4'):
+        try:
+            db.execute(f"CREATE VIRTUAL TABLE nodes_fts USING {module}("
+                       f"content, content='nodes', content_rowid='id')")
+        except sqlite3.OperationalError:
+            continue
+        db.execute("INSERT INTO nodes_fts(nodes_fts) VALUES ('rebuild')")
+        return module
+    return None
+
+def write_sqlite_export(db_path, chats, source_filename):
+    """Экспорт в базу SQLite: таблицы chats, nodes, branches и nodes_fts
+    
+    Строки копятся пачками по SQLITE_BATCH_ROWS и вставляются через
+    executemany в одной транзакции; индексы и полнотекстовый индекс
+    строятся один раз после загрузки. База пишется во временный файл
+    рядом с результатом и переименовывается только после успешного
+    завершения. Возвращает количество чатов.
+    """
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    
+    db = sqlite3.connect(tmp_path)
+    try:
+        # Файл временный: журнал и fsync не нужны, при ошибке он удаляется
+        db.execute("PRAGMA journal_mode = OFF")
+        db.execute("PRAGMA synchronous = OFF")
+        db.executescript(SQLITE_SCHEMA)
+        
+        chat_rows, node_rows, branch_rows = [], [], []
+        
+        def flush():
+            if _profiler is not None:
+                started = time.perf_counter()
+            db.executemany("INSERT INTO chats VALUES (?, ?, ?, ?, ?, ?, ?, ?)", chat_rows)
+            db.executemany("INSERT INTO nodes (chat_index, node_id, parent_id, role, content, model, "
+                           "inserted_at) VALUES (?, ?, ?, ?, ?, ?, ?)", node_rows)
+            db.executemany("INSERT INTO branches VALUES (?, ?, ?, ?, ?, ?, ?)", branch_rows)
+            if _profiler is not None:
+                _profiler.add('sqlite', time.perf_counter() - started, 1,
+                              len(chat_rows) + len(node_rows) + len(branch_rows))
+            chat_rows.clear()
+            node_rows.clear()
+            branch_rows.clear()
+        
+        total_chats = 0
+        for total_chats, chat in enumerate(chats, 1):
+            chat_row, chat_nodes, chat_branches = sqlite_chat_rows(total_chats, load_chat(chat))
+            chat_rows.append(chat_row)
+            node_rows.extend(chat_nodes)
+            branch_rows.extend(chat_branches)
+            if len(node_rows) >= SQLITE_BATCH_ROWS:
+                flush()
+        flush()
+        
+        if _profiler is not None:
+            started = time.perf_counter()
+        db.executescript(SQLITE_INDEXES)
+        fts_module = create_sqlite_fts(db)
+        if _profiler is not None:
+            _profiler.add('sqlite_index', time.perf_counter() - started)
+        
+        db.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ('source', os.path.basename(source_filename)),
+            ('exported_at', datetime.now().isoformat(timespec='seconds')),
+            ('fts', fts_module or ''),
+        ])
+        db.commit()
+    except BaseException:
+        db.close()
+        os.remove(tmp_path)
+        raise
+    db.close()
+    
+    os.replace(tmp_path, db_path)
+    return total_chats
+
+def iter_rendered_chats(chats, branch_layout='full', jobs=1, chunk_size=PARALLEL_CHUNK_SIZE,
+                        manifest=None, executor=None, search=False):
+    """Тройки (HTML элемента оглавления, фрагменты HTML чата, данные для
+    поиска или None) в исходном порядке
+    
+    При jobs > 1 чаты отправляются в ProcessPoolExecutor пачками по
+    chunk_size; в работе одновременно не больше 2 * jobs пачек, поэтому
+    память ограничена независимо от размера экспорта. С манифестом
+    (RenderManifest) неизмененные чаты берутся из кэша без рендеринга.
+    Готовый executor позволяет использовать один пул для нескольких
+    экспортов подряд. Чаты - словари или ChatSlice: срезы декодируются
+    только при рендеринге, а в воркеры уходят лишь их границы в файле.
+    """
+    if jobs <= 1:
+        for i, chat in enumerate(chats, 1):
+            if manifest is None and _profiler is None:
+                chat = load_chat(chat)
+                analysis = ChatAnalysis(i, chat)
+                search_data = chat_search_entries(analysis) if search else None
+                yield (render_toc_item(analysis), iter_chat_with_accordion(i, chat, branch_layout, analysis),
+                       search_data)
+                continue
+            
+            chat_hash = parts = None
+            if manifest is not None:
+                chat_hash = chat_fingerprint(chat)
+                parts = manifest.get(chat_hash)
+            if parts is None:
+                chat = load_chat(chat)
+                started = time.perf_counter()
+                parts = render_chat_parts(chat, branch_layout, search)
+                if _profiler is not None:
+                    record_chat_profile(i, chat, parts, time.perf_counter() - started)
+                if manifest is not None:
+                    manifest.put(chat_hash, parts)
+            yield splice_chat_parts(parts, i)
+        return
+    
+    if executor is None:
+        with create_executor(jobs) as executor:
+            yield from iter_rendered_chats(chats, branch_layout, jobs, chunk_size, manifest, executor, search)
+        return
+    
+    max_in_flight = jobs * 2
+    
+    pending = deque()
+    batch = []
+    
+    def submit():
+        # В воркеры уходят только чаты, которых нет в манифесте
+        misses = [chat for _, _, parts, chat in batch if parts is None]
+        future = None
+        if misses:
+            future = executor.submit(render_chat_batch, misses, branch_layout, _profiler is not None, search)
+        pending.append(([(i, chat_hash, parts) for i, chat_hash, parts, _ in batch], future))
+    
+    def collect():
+        items, future = pending.popleft()
+        rendered, stats = future.result() if future else ((), None)
+        rendered = iter(rendered)
+        if stats is not None:
+            chat_stats = iter(stats.pop('chats'))
+            _profiler.merge(dict(stats, chats=[]))
+        for i, chat_hash, parts in items:
+            if parts is None:
+                parts = next(rendered)
+                if stats is not None:
+                    title, seconds, size, nodes = next(chat_stats)
+                    _profiler.add_chat(i, title, seconds, size, nodes)
+                if manifest is not None:
+                    manifest.put(chat_hash, parts)
+            yield splice_chat_parts(parts, i)
+    
+    for i, chat in enumerate(chats, 1):
+        chat_hash = parts = None
+        if manifest is not None:
+            chat_hash = chat_fingerprint(chat)
+            parts = manifest.get(chat_hash)
+        batch.append((i, chat_hash, parts, chat))
+        
+        if len(batch) >= chunk_size:
+            submit()
+            batch = []
+            
+            # Ждем самую старую пачку, чтобы не раздувать очередь
+            while len(pending) >= max_in_flight:
+                yield from collect()
+    
+    if batch:
+        submit()
+    
+    while pending:
+        yield from collect()
+
+def create_executor(jobs):
+    """Пул процессов для рендеринга; воркеры получают текущие настройки ролей,
+    лимиты дерева и кэша фрагментов"""
+    return ProcessPoolExecutor(max_workers=jobs, initializer=configure_rendering,
+                               initargs=(_role_classifier.config, _tree_limits, _render_cache_config))
+
+def render_chat_batch(chats, branch_layout='full', profile=False, search=False):
+    """Рендер пачки чатов (выполняется в процессе-воркере)
+    
+    ChatSlice декодируются здесь же, из отображения файла в памяти воркера.
+    Возвращает результаты render_chat_parts и, при profile, статистику
+    профилировщика воркера; в ней для чатов вместо номера - заголовок.
+    """
+    profiler = ExportProfiler() if profile else None
+    previous = set_profiler(profiler)
+    try:
+        results = []
+        for chat in chats:
+            chat = load_chat(chat)
+            started = time.perf_counter()
+            parts = render_chat_parts(chat, branch_layout, search)
+            results.append(parts)
+            if profiler is not None:
+                seconds = time.perf_counter() - started
+                size = parts_size(parts)
+                profiler.add('render_chat', seconds, 1, size)
+                profiler.chats.append((chat.get('title', ''), seconds, size, len(chat.get('mapping', {}))))
+        if _render_cache is not None:
+            _render_cache.flush()
+    finally:
+        set_profiler(previous)
+    
+    return results, profiler.stats() if profiler is not None else None
+
+def record_chat_profile(index, chat, parts, seconds):
+    """Учет отрендеренного чата в активном профилировщике"""
+    _profiler.add('render_chat', seconds, 1, parts_size(parts))
+    _profiler.add_chat(index, chat.get('title', f'Чат {index}'), seconds, parts_size(parts),
+                       len(chat.get('mapping', {})))
+
+def parts_size(parts):
+    """Размер HTML результата render_chat_parts в символах"""
+    toc_parts, chat_parts, _ = parts
+    return sum(map(len, toc_parts)) + sum(map(len, chat_parts))
+
+def render_chat_parts(chat, branch_layout='full', search=False):
+    """HTML оглавления и чата, разрезанный по местам подстановки номера чата
+    
+    Чат рендерится с меткой вместо номера, поэтому один и тот же
+    результат подходит для любой позиции чата в экспорте. Третий
+    элемент - данные для поискового индекса (при search) или None.
+    """
+    analysis = ChatAnalysis(INDEX_PLACEHOLDER, chat)
+    toc_html = render_toc_item(analysis)
+    chat_html = ''.join(iter_chat_with_accordion(INDEX_PLACEHOLDER, chat, branch_layout, analysis))
+    search_data = chat_search_entries(analysis) if search else None
+    return toc_html.split(INDEX_PLACEHOLDER), chat_html.split(INDEX_PLACEHOLDER), search_data
+
+def splice_chat_parts(parts, index):
+    """Подстановка номера чата в результат render_chat_parts"""
+    toc_parts, chat_parts, search_data = parts
+    number = str(index)
+    if search_data is not None:
+        # Заголовок чата без названия содержит метку вместо номера
+        title, entries = search_data
+        search_data = number.join(title.split(INDEX_PLACEHOLDER)), entries
+    return number.join(toc_parts), [number.join(chat_parts)], search_data
+
+def index_chat(index, chat, search=False):
+    """Разбор чата для оглавления и поиска без рендеринга сообщений
+    
+    Возвращает HTML элемента оглавления, запись оглавления для JSON API
+    и данные для поискового индекса (при search) или None.
+    """
+    analysis = ChatAnalysis(index, load_chat(chat))
+    entry = {
+        'chat': index,
+        'title': analysis.title,
+        'inserted_at': analysis.inserted_at,
+        'branches': analysis.branches_count,
+        'messages': analysis.total_messages,
+        'truncated': analysis.truncation_note() or None,
+    }
+    return render_toc_item(analysis), entry, chat_search_entries(analysis) if search else None
+
+def index_chat_batch(chats, first_index, search=False):
+    """index_chat для пачки чатов с номерами от first_index (выполняется в процессе-воркере)"""
+    return [index_chat(i, chat, search) for i, chat in enumerate(chats, first_index)]
+
+def iter_indexed_chats(chats, jobs=1, chunk_size=PARALLEL_CHUNK_SIZE, search=False):
+    """Результаты index_chat по всем чатам в исходном порядке
+    
+    При jobs > 1 пачки по chunk_size разбираются в пуле процессов,
+    в работе одновременно не больше 2 * jobs пачек.
+    """
+    if jobs <= 1:
+        for i, chat in enumerate(chats, 1):
+            yield index_chat(i, chat, search)
+        return
+    
+    pending = deque()
+    batch = []
+    with create_executor(jobs) as executor:
+        for i, chat in enumerate(chats, 1):
+            batch.append(chat)
+            if len(batch) >= chunk_size:
+                pending.append(executor.submit(index_chat_batch, batch, i - len(batch) + 1, search))
+                batch = []
+                while len(pending) >= jobs * 2:
+                    yield from pending.popleft().result()
+        if batch:
+            pending.append(executor.submit(index_chat_batch, batch, i - len(batch) + 1, search))
+        while pending:
+            yield from pending.popleft().result()
+
+def chat_fingerprint(chat):
+    """Хэш содержимого чата (mapping, заголовок и прочие поля)
+    
+    Для ChatSlice хэшируются исходные байты чата без декодирования JSON.
+    """
+    if isinstance(chat, ChatSlice):
+        return chat.fingerprint()
+    canonical = json.dumps(chat, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return content_digest(canonical)
+
+def code_signature():
+    """Отпечаток кода модуля: при изменении кэш фрагментов на диске сбрасывается"""
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+
+def render_signature(branch_layout, search=False):
+    """Отпечаток кода рендеринга и настроек: при изменении кэш сбрасывается"""
+    with open(os.path.abspath(__file__), 'rb') as f:
+        source = f.read()
+    settings = json.dumps([branch_layout, search, _role_classifier.config, _tree_limits],
+                          sort_keys=True).encode('utf-8')
+    return hashlib.blake2b(source + settings, digest_size=16).hexdigest()
+
+
+class RenderManifest:
+    """Манифест инкрементального экспорта (sqlite3 рядом с результатами)
+    
+    Для каждого чата хранится хэш содержимого, готовые фрагменты HTML
+    (оглавление и тело чата) и данные для поискового индекса. При повторном экспорте рендерятся только
+    новые и измененные чаты; записи чатов, которых больше нет в экспорте,
+    удаляются в finish().
+    """
+    
+    def __init__(self, path, signature):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._run_id = time.time_ns()
         
-        if first_node_id not in grouped:
-            grouped[first_node_id] = []
+        self._db = sqlite3.connect(path)
+        self._db.execute('''CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY, value TEXT)''')
         
-        grouped[first_node_id].append(branch)
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+        if row is None or row[0] != signature:
+            # Изменился код рендеринга или настройки - старые фрагменты не годятся
+            # (таблица пересоздается, так как могла измениться и ее схема)
+            self._db.execute("DROP TABLE IF EXISTS chats")
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (signature,))
+        self._db.execute('''CREATE TABLE IF NOT EXISTS chats (
+            chat_hash TEXT PRIMARY KEY, toc_parts TEXT, chat_parts TEXT, search TEXT, run_id INTEGER)''')
     
-    # Сортируем ветки по количеству сообщений (самые длинные первые)
-    result = []
-    for first_node_id, branch_list in grouped.items():
-        sorted_branches = sorted(branch_list, key=len, reverse=True)
-        result.extend(sorted_branches)
+    def get(self, chat_hash):
+        if _profiler is not None:
+            started = time.perf_counter()
+            parts = self._get(chat_hash)
+            _profiler.add('manifest', time.perf_counter() - started, 1,
+                          parts_size(parts) if parts is not None else 0)
+            return parts
+        return self._get(chat_hash)
     
-    return result
-
-def create_html_full_markdown(chats, source_filename, timestamp, cache_buster):
-    """HTML с полной поддержкой Markdown и аккордеоном для веток"""
+    def _get(self, chat_hash):
+        row = self._db.execute(
+            "SELECT toc_parts, chat_parts, search FROM chats WHERE chat_hash = ?", (chat_hash,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute("UPDATE chats SET run_id = ? WHERE chat_hash = ?", (self._run_id, chat_hash))
+        return json.loads(row[0]), json.loads(row[1]), json.loads(row[2])
     
-    total_chats = len(chats)
-    export_time = datetime.now().strftime('%d.%m.%Y %H:%M:%S')
-    source_name = os.path.basename(source_filename)
+    def put(self, chat_hash, parts):
+        toc_parts, chat_parts, search_data = parts
+        self._db.execute(
+            "INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?)",
+            (chat_hash, json.dumps(toc_parts, ensure_ascii=False),
+             json.dumps(chat_parts, ensure_ascii=False),
+             json.dumps(search_data, ensure_ascii=False), self._run_id))
     
-    html = f'''<!DOCTYPE html>
+    def finish(self, prune=True):
+        """Сохранение манифеста; prune - удаление записей чатов, которых не
+        было в этом экспорте (при выборочном экспорте записи сохраняются)"""
+        if prune:
+            self._db.execute("DELETE FROM chats WHERE run_id != ?", (self._run_id,))
+        self._db.commit()
+        self._db.close()
+    
+    def close(self):
+        """Закрытие без сохранения (например, после ошибки экспорта)"""
+        self._db.rollback()
+        self._db.close()
+
+def render_toc_item(analysis):
+    """Элемент оглавления для чата"""
+    i = analysis.index
+    title = html_module.escape(analysis.title)
+    date_str = analysis.date_str
+    branches_count = analysis.branches_count
+    total_messages = analysis.total_messages
+    truncated = ''
+    if analysis.truncated:
+        truncated = f'<span title="Чат показан не полностью: {analysis.truncation_note()}">⚠️</span>'
+    
+    return f'''
+                <div class="toc-item" data-chat="{i}">
+                    <div class="toc-title">{title}</div>
+                    <div class="toc-meta">
+                        <span>#{i}</span>
+                        <span>📅 {date_str}</span>
+                        <span>🌿 {branches_count}</span>
+                        <span>💬 {total_messages}</span>
+                        {truncated}
+                    </div>
+                </div>
+'''
+
+def render_page_head(total_chats, source_name, export_time, timestamp, cache_buster):
+    """Начало документа: стили, шапка и открытие оглавления"""
+    return f'''<!DOCTYPE html>
 <html lang="ru">
 <head>
     <meta charset="UTF-8">
@@ -420,6 +2441,88 @@ def create_html_full_markdown(chats, source_filename, timestamp, cache_buster):
             font-size: 0.9em;
         }}
         
+        /* ПОИСК */
+        .search-box {{
+            background: white;
+            border-radius: 10px;
+            padding: 20px 25px;
+            margin-bottom: 30px;
+            box-shadow: 0 3px 15px rgba(0,0,0,0.08);
+        }}
+        
+        .search-box input {{
+            width: 100%;
+            box-sizing: border-box;
+            padding: 12px 15px;
+            font-size: 1em;
+            border: 2px solid #e2e8f0;
+            border-radius: 8px;
+            outline: none;
+        }}
+        
+        .search-box input:focus {{
+            border-color: #667eea;
+        }}
+        
+        .search-status {{
+            font-size: 0.85em;
+            color: #718096;
+            margin-top: 8px;
+        }}
+        
+        .search-results {{
+            max-height: 60vh;
+            overflow-y: auto;
+        }}
+        
+        .search-result {{
+            display: block;
+            padding: 10px 12px;
+            margin-top: 8px;
+            border-radius: 6px;
+            border-left: 4px solid #667eea;
+            background: #f8f9fa;
+            color: inherit;
+            text-decoration: none;
+        }}
+        
+        .search-result:hover {{
+            background: #eef2ff;
+        }}
+        
+        .search-result-title {{
+            font-weight: bold;
+            color: #2d3748;
+        }}
+        
+        .search-result-meta {{
+            font-size: 0.8em;
+            color: #718096;
+        }}
+        
+        .search-result-preview {{
+            font-size: 0.9em;
+            color: #4a5568;
+            overflow: hidden;
+            text-overflow: ellipsis;
+            white-space: nowrap;
+        }}
+        
+        .message.search-hit {{
+            box-shadow: 0 0 0 3px rgba(255, 193, 7, 0.8);
+        }}
+        
+        /* Сжатый чат до распаковки */
+        .chat-packed {{
+            min-height: 200px;
+        }}
+        
+        .chat-packed-note {{
+            padding: 20px;
+            color: #718096;
+            text-align: center;
+        }}
+        
         /* ОГЛАВЛЕНИЕ */
         .toc {{
             background: white;
@@ -471,6 +2574,20 @@ def create_html_full_markdown(chats, source_filename, timestamp, cache_buster):
             justify-content: space-between;
         }}
         
+        .toc-pager {{
+            display: flex;
+            justify-content: center;
+            align-items: center;
+            gap: 20px;
+            margin-bottom: 30px;
+        }}
+        
+        .toc-pager a {{
+            color: #667eea;
+            text-decoration: none;
+            font-weight: bold;
+        }}
+        
         /* ЧАТЫ */
         .chat {{
             background: white;
@@ -489,6 +2606,14 @@ def create_html_full_markdown(chats, source_filename, timestamp, cache_buster):
             border-left: 4px solid #6c757d;
         }}
         
+        .chat-truncated {{
+            margin-top: 10px;
+            padding: 8px 12px;
+            border-radius: 6px;
+            background: #fff3cd;
+            color: #856404;
+        }}
+        
         /* УПРАВЛЕНИЕ ВЕТКАМИ */
         .branches-controls {{
             display: flex;
@@ -621,6 +2746,61 @@ def create_html_full_markdown(chats, source_filename, timestamp, cache_buster):
             max-height: 5000px;
         }}
         
+        .branch-prefix-ref {{
+            margin: 15px 0;
+            padding: 10px 15px;
+            border-radius: 8px;
+            border: 1px dashed #667eea;
+            color: #5a67d8;
+            font-size: 0.9em;
+        }}
+        
+        /* ДЕРЕВО ОТВЕТВЛЕНИЙ (branch_layout = fork) */
+        .fork-trunk-note {{
+            margin-bottom: 10px;
+            color: #718096;
+            font-size: 0.9em;
+        }}
+        
+        .fork-point {{
+            margin: 10px 0 20px 20px;
+            padding-left: 15px;
+            border-left: 3px dashed #667eea;
+        }}
+        
+        .fork-alt {{
+            margin: 8px 0;
+        }}
+        
+        .fork-alt > summary {{
+            cursor: pointer;
+            padding: 10px 15px;
+            border-radius: 8px;
+            background: #f0f3ff;
+            display: flex;
+            flex-wrap: wrap;
+            align-items: center;
+            gap: 10px;
+        }}
+        
+        .fork-alt[open] > summary {{
+            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+            color: white;
+        }}
+        
+        .fork-alt[open] > summary .branch-stats {{
+            color: rgba(255, 255, 255, 0.9);
+        }}
+        
+        .fork-alt-preview {{
+            flex-basis: 100%;
+            font-size: 0.85em;
+            opacity: 0.8;
+            overflow: hidden;
+            text-overflow: ellipsis;
+            white-space: nowrap;
+        }}
+        
         /* СООБЩЕНИЯ */
         .message {{
             margin: 15px 0;
@@ -944,63 +3124,60 @@ def create_html_full_markdown(chats, source_filename, timestamp, cache_buster):
             <span style="margin-left: 10px; font-size: 0.9em;">Или нажмите Ctrl+F5 / Cmd+Shift+R</span>
         </div>
         
-        <div class="toc" id="toc">
+'''
+
+TOC_OPEN = '''        <div class="toc" id="toc">
             <h2>📑 Оглавление</h2>
             <div class="toc-grid">
 '''
-    
-    # Добавляем оглавление
-    for i, chat in enumerate(chats, 1):
-        title = html_module.escape(chat.get('title', f'Чат {i}'))
-        date_str = ""
-        inserted = chat.get('inserted_at', '')
-        if inserted:
-            try:
-                date_obj = datetime.fromisoformat(inserted.replace('Z', '+00:00'))
-                date_str = date_obj.strftime('%d.%m.%Y')
-            except:
-                date_str = inserted[:10] if len(inserted) >= 10 else inserted
-        
-        # Извлекаем все ветки для подсчета
-        all_branches = extract_all_branches(chat)
-        branches_count = len(all_branches)
-        total_messages = sum(len(branch) for branch in all_branches)
-        
-        # Подсчет сообщений по ролям
-        role_stats = {'user': 0, 'assistant': 0, 'unknown': 0}
-        for branch in all_branches:
-            for msg in branch:
-                role = msg.get('role', 'unknown')
-                role_stats[role] = role_stats.get(role, 0) + 1
-        
-        html += f'''
-                <div class="toc-item" data-chat="{i}">
-                    <div class="toc-title">{title}</div>
-                    <div class="toc-meta">
-                        <span>#{i}</span>
-                        <span>📅 {date_str}</span>
-                        <span>🌿 {branches_count}</span>
-                        <span>💬 {total_messages}</span>
-                    </div>
-                </div>
-'''
-    
-    html += '''
+
+TOC_CLOSE = '''
             </div>
         </div>
 '''
+
+# Ссылка на оглавление со страницы части экспорта
+SHARD_TOC_LINK = '''        <div class="toc"><a href="index.html">📑 К оглавлению</a></div>
+'''
+
+def render_toc_pager(page, pages):
+    """Переключатель страниц оглавления (режим --serve)"""
+    links = []
+    if page > 1:
+        links.append(f'<a href="index.html?page={page - 1}">← Назад</a>')
+    links.append(f'<span>Страница {page} из {pages}</span>')
+    if page < pages:
+        links.append(f'<a href="index.html?page={page + 1}">Вперед →</a>')
+    separator = '\n            '
+    return f'''        <div class="toc-pager">
+            {separator.join(links)}
+        </div>
+'''
+
+def render_page_tail(cache_buster, toc_href='#toc', shard_size=0, search_api=''):
+    """Конец документа: кнопка "Наверх" и JavaScript - ФИКСИРОВАННАЯ ЧАСТЬ
     
-    # Добавляем чаты с ветвлениями
-    for i, chat in enumerate(chats, 1):
-        html += create_chat_with_accordion(i, chat)
-    
-    # Кнопка "Наверх" и JavaScript - ФИКСИРОВАННАЯ ЧАСТЬ
-    html += f'''
-    <a href="#toc" class="back-to-top" id="backToTop">↑</a>
+    shard_size > 0 - страница-оглавление разбитого на части экспорта:
+    клик по чату открывает файл части с этим чатом. search_api - адрес
+    поиска на сервере (режим --serve) вместо встроенного индекса.
+    """
+    return f'''
+    <a href="{toc_href}" class="back-to-top" id="backToTop">↑</a>
     
     <script>
         // Cache buster: {cache_buster}
         
+        // Размер части экспорта (0 - все чаты в одном файле)
+        const SHARD_SIZE = {shard_size};
+        
+        // Адрес поиска на сервере ('' - поиск по встроенному индексу)
+        const SEARCH_API = '{search_api}';
+        
+        function shardFile(chatNumber) {{
+            const shard = Math.ceil(chatNumber / SHARD_SIZE);
+            return 'chats_' + String(shard).padStart(5, '0') + '.html';
+        }}
+        
         // Принудительная перезагрузка с очисткой кэша
         function hardReload() {{
             console.log('Принудительная перезагрузка...');
@@ -1034,6 +3211,367 @@ def create_html_full_markdown(chats, source_filename, timestamp, cache_buster):
             }});
         }}
         
+        // Подстановка общего начала ветки (режим branch_layout = shared):
+        // сообщения копируются из ветки, где они уже выведены
+        function materializeBranch(content) {{
+            const ref = content.querySelector(':scope > .branch-prefix-ref');
+            if (!ref) {{
+                return;
+            }}
+            const source = document.getElementById(ref.getAttribute('data-source'));
+            if (!source) {{
+                return;
+            }}
+            inflateBranch(source);
+            materializeBranch(source);
+            
+            const count = parseInt(ref.getAttribute('data-count'), 10);
+            const messages = source.querySelectorAll(':scope > .message');
+            const fragment = document.createDocumentFragment();
+            for (let k = 0; k < count && k < messages.length; k++) {{
+                fragment.appendChild(messages[k].cloneNode(true));
+            }}
+            ref.replaceWith(fragment);
+        }}
+        
+        // Тело ветки хранится в инертном <template> и попадает в DOM
+        // только при первом открытии ветки
+        function inflateBranch(content) {{
+            const template = content.querySelector(':scope > template.branch-body');
+            if (template) {{
+                template.replaceWith(template.content);
+            }}
+        }}
+        
+        function openBranch(header, content) {{
+            inflateBranch(content);
+            materializeBranch(content);
+            header.classList.add('active');
+            content.classList.add('active');
+            content.style.maxHeight = content.scrollHeight + "px";
+        }}
+        
+        function closeBranch(header, content) {{
+            header.classList.remove('active');
+            content.classList.remove('active');
+            content.style.maxHeight = null;
+        }}
+        
+        function toggleBranch(header) {{
+            const content = header.nextElementSibling;
+            const isActive = header.classList.contains('active');
+            
+            // Закрываем все открытые аккордеоны в этой группе
+            const parent = header.closest('.accordion-container');
+            parent.querySelectorAll('.accordion-header.active').forEach(h => {{
+                closeBranch(h, h.nextElementSibling);
+            }});
+            
+            // Открываем текущий, если был закрыт
+            if (!isActive) {{
+                openBranch(header, content);
+                
+                // Подсветка открытой ветки
+                const item = header.parentElement;
+                item.classList.add('highlight');
+                setTimeout(() => {{
+                    item.classList.remove('highlight');
+                }}, 2000);
+            }}
+        }}
+        
+        // Раскрытие свернутых ответвлений (branch_layout = fork), в которых
+        // есть ветка branch (без branch - всех); вложенные блоки появляются
+        // в DOM только после раскрытия внешних
+        function revealForkBranches(chatElement, branch) {{
+            const selector = branch === undefined
+                ? 'details.fork-alt:not([open])'
+                : 'details.fork-alt:not([open])[data-branches~="' + branch + '"]';
+            let details;
+            while ((details = chatElement.querySelector(selector))) {{
+                details.open = true;
+                inflateBranch(details);
+            }}
+        }}
+        
+        function setChatBranches(chatId, expand) {{
+            const chatElement = document.getElementById('chat-' + chatId);
+            if (expand) {{
+                revealForkBranches(chatElement);
+            }} else {{
+                chatElement.querySelectorAll('details.fork-alt[open]').forEach(details => {{
+                    details.open = false;
+                }});
+            }}
+            
+            const headers = document.querySelectorAll('#chat-' + chatId + ' .accordion-header');
+            headers.forEach(header => {{
+                if (expand) {{
+                    openBranch(header, header.nextElementSibling);
+                }} else {{
+                    closeBranch(header, header.nextElementSibling);
+                }}
+            }});
+            console.log(expand ? 'Развернуты все ветки в чате' : 'Свернуты все ветки в чате', chatId);
+        }}
+        
+        // Плавная прокрутка к чату при клике на элемент оглавления
+        function openTocItem(item) {{
+            const chatNumber = item.getAttribute('data-chat');
+            const chatElement = document.getElementById('chat-' + chatNumber);
+            
+            if (chatElement) {{
+                chatElement.scrollIntoView({{
+                    behavior: 'smooth',
+                    block: 'start'
+                }});
+                
+                // Подсветка чата
+                chatElement.style.boxShadow = '0 0 0 3px rgba(102, 126, 234, 0.3)';
+                setTimeout(() => {{
+                    chatElement.style.boxShadow = '';
+                }}, 2000);
+            }} else if (SHARD_SIZE > 0) {{
+                window.location.href = shardFile(parseInt(chatNumber, 10)) + '#chat-' + chatNumber;
+            }}
+        }}
+        
+        // Сжатые данные (zlib + base64) распаковываются средствами браузера
+        function inflatePayload(encoded) {{
+            const binary = atob(encoded.replace(/\\s+/g, ''));
+            const bytes = new Uint8Array(binary.length);
+            for (let i = 0; i < binary.length; i++) {{
+                bytes[i] = binary.charCodeAt(i);
+            }}
+            const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('deflate'));
+            return new Response(stream).text();
+        }}
+        
+        // Чат готов к работе: сжатый (.chat-packed) сначала распаковывается
+        // и подменяет заглушку; распаковка выполняется один раз
+        const loadedChats = new Map();
+        
+        function loadChat(chatElement) {{
+            if (!chatElement.classList.contains('chat-packed')) {{
+                return Promise.resolve(chatElement);
+            }}
+            const chatId = chatElement.id;
+            if (!loadedChats.has(chatId)) {{
+                const payload = chatElement.querySelector('.chat-payload');
+                loadedChats.set(chatId, inflatePayload(payload.textContent).then(html => {{
+                    const template = document.createElement('template');
+                    template.innerHTML = html;
+                    const chat = template.content.querySelector('.chat');
+                    chatElement.replaceWith(template.content);
+                    return chat;
+                }}).catch(error => {{
+                    console.error('Не удалось распаковать чат', chatId, error);
+                    chatElement.querySelector('.chat-packed-note').textContent =
+                        '❌ Браузер не поддерживает распаковку (DecompressionStream)';
+                    throw error;
+                }}));
+            }}
+            return loadedChats.get(chatId);
+        }}
+        
+        // Поиск по встроенному индексу (<script id="search-index">):
+        // JSON разбирается (и распаковывается) при первом запросе,
+        // DOM не просматривается
+        const SEARCH_RESULT_LIMIT = 100;
+        const SEARCH_ROLE_ICONS = {{ u: '👤', a: '🤖' }};
+        let searchIndex = null;
+        
+        function getSearchIndex() {{
+            if (searchIndex === null) {{
+                const script = document.getElementById('search-index');
+                if (!script) {{
+                    searchIndex = Promise.resolve(false);
+                }} else if (script.getAttribute('data-encoding') === 'deflate') {{
+                    searchIndex = inflatePayload(script.textContent).then(JSON.parse);
+                }} else {{
+                    searchIndex = Promise.resolve(JSON.parse(script.textContent));
+                }}
+                searchIndex = searchIndex.then(index => {{
+                    if (index) {{
+                        index.decoded = new Map();
+                    }}
+                    return index;
+                }});
+            }}
+            return searchIndex;
+        }}
+        
+        function searchTokens(text) {{
+            return (text.toLowerCase().replace(/ё/g, 'е').match(/[\\p{{L}}\\p{{N}}]+/gu) || [])
+                .filter(token => token.length >= {SEARCH_MIN_TOKEN_LENGTH});
+        }}
+        
+        // Номера сообщений для слова (в индексе - разности соседних номеров)
+        function termDocs(index, termNumber) {{
+            let docs = index.decoded.get(termNumber);
+            if (!docs) {{
+                let doc = 0;
+                docs = index.postings[termNumber].map(delta => doc += delta);
+                index.decoded.set(termNumber, docs);
+            }}
+            return docs;
+        }}
+        
+        // Диапазон слов словаря, начинающихся с prefix (словарь отсортирован)
+        function prefixRange(terms, prefix) {{
+            const lowerBound = value => {{
+                let lo = 0, hi = terms.length;
+                while (lo < hi) {{
+                    const mid = (lo + hi) >> 1;
+                    if (terms[mid] < value) {{
+                        lo = mid + 1;
+                    }} else {{
+                        hi = mid;
+                    }}
+                }}
+                return lo;
+            }};
+            return [lowerBound(prefix), lowerBound(prefix + '\uffff')];
+        }}
+        
+        // Сообщения, содержащие все слова запроса (каждое - как начало слова)
+        function runSearch(index, query) {{
+            const tokens = searchTokens(query);
+            if (!index || tokens.length === 0) {{
+                return [];
+            }}
+            let result = null;
+            for (const token of tokens) {{
+                const [from, to] = prefixRange(index.terms, token);
+                const docs = new Set();
+                for (let t = from; t < to; t++) {{
+                    termDocs(index, t).forEach(doc => {{
+                        if (result === null || result.has(doc)) {{
+                            docs.add(doc);
+                        }}
+                    }});
+                }}
+                result = docs;
+                if (result.size === 0) {{
+                    break;
+                }}
+            }}
+            return Array.from(result).sort((a, b) => a - b);
+        }}
+        
+        function searchTargetHash(chat, branch, node) {{
+            return '#chat-' + chat + '/' + branch + '/' + encodeURIComponent(node);
+        }}
+        
+        let searchQuery = '';
+        
+        async function showSearchResults(query) {{
+            const status = document.getElementById('searchStatus');
+            const container = document.getElementById('searchResults');
+            searchQuery = query;
+            if (searchTokens(query).length === 0) {{
+                container.textContent = '';
+                status.textContent = '';
+                return;
+            }}
+            
+            // Найденные сообщения: [чат, ветка, узел, роль, начало текста, заголовок чата]
+            let total;
+            let hits;
+            if (SEARCH_API) {{
+                const response = await fetch(SEARCH_API + '?limit=' + SEARCH_RESULT_LIMIT +
+                                             '&q=' + encodeURIComponent(query));
+                const data = await response.json();
+                if (query !== searchQuery) {{
+                    return;  // пока сервер отвечал, запрос изменился
+                }}
+                total = data.total;
+                hits = data.results.map(hit => [hit.chat, hit.branch, hit.node, hit.role, hit.preview, hit.title]);
+            }} else {{
+                const index = await getSearchIndex();
+                if (query !== searchQuery) {{
+                    return;  // пока индекс распаковывался, запрос изменился
+                }}
+                const found = runSearch(index, query);
+                total = found.length;
+                hits = found.slice(0, SEARCH_RESULT_LIMIT).map(doc => {{
+                    return index.docs[doc].concat([index.titles[index.docs[doc][0] - 1]]);
+                }});
+            }}
+            container.textContent = '';
+            status.textContent = total > SEARCH_RESULT_LIMIT
+                ? 'Найдено сообщений: ' + total + ' (показаны первые ' + SEARCH_RESULT_LIMIT + ')'
+                : 'Найдено сообщений: ' + total;
+            
+            const fragment = document.createDocumentFragment();
+            hits.forEach(([chat, branch, node, role, preview, chatTitle]) => {{
+                const link = document.createElement('a');
+                link.className = 'search-result';
+                link.href = searchTargetHash(chat, branch, node);
+                link.setAttribute('data-chat', chat);
+                link.setAttribute('data-branch', branch);
+                link.setAttribute('data-node', node);
+                
+                const title = document.createElement('div');
+                title.className = 'search-result-title';
+                title.textContent = chatTitle || ('Чат ' + chat);
+                const meta = document.createElement('div');
+                meta.className = 'search-result-meta';
+                meta.textContent = (SEARCH_ROLE_ICONS[role] || '❓') + ' #' + chat +
+                    ' · Ветка #' + branch + ' · узел: ' + node;
+                const text = document.createElement('div');
+                text.className = 'search-result-preview';
+                text.textContent = preview;
+                
+                link.append(title, meta, text);
+                fragment.appendChild(link);
+            }});
+            container.appendChild(fragment);
+        }}
+        
+        // Переход к сообщению: открываем ветку и прокручиваем к узлу
+        async function openSearchTarget(chat, branch, node) {{
+            let chatElement = document.getElementById('chat-' + chat);
+            if (!chatElement) {{
+                if (SHARD_SIZE > 0) {{
+                    window.location.href = shardFile(chat) + searchTargetHash(chat, branch, node);
+                }}
+                return;
+            }}
+            chatElement = await loadChat(chatElement);
+            revealForkBranches(chatElement, branch);
+            
+            const items = chatElement.querySelectorAll('.accordion-container > .accordion-item');
+            const item = items[branch - 1];
+            const nodeSelector = '.message[data-node="' + CSS.escape(String(node)) + '"]';
+            let target = chatElement;
+            if (item) {{
+                const header = item.querySelector('.accordion-header');
+                if (!header.classList.contains('active')) {{
+                    toggleBranch(header);
+                }}
+                target = item.querySelector(nodeSelector) || item;
+            }} else {{
+                target = chatElement.querySelector(nodeSelector) || chatElement;
+            }}
+            
+            target.scrollIntoView({{
+                behavior: 'smooth',
+                block: 'center'
+            }});
+            target.classList.add('search-hit');
+            setTimeout(() => {{
+                target.classList.remove('search-hit');
+            }}, 2000);
+        }}
+        
+        function openHashTarget() {{
+            const match = /^#chat-(\\d+)\\/(\\d+)\\/(.+)$/.exec(window.location.hash);
+            if (match) {{
+                openSearchTarget(parseInt(match[1], 10), parseInt(match[2], 10), decodeURIComponent(match[3]));
+            }}
+        }}
+        
         document.addEventListener('DOMContentLoaded', function() {{
             console.log('Документ загружен. Cache buster: {cache_buster}');
             
@@ -1045,29 +3583,6 @@ def create_html_full_markdown(chats, source_filename, timestamp, cache_buster):
                 }}
             }}, 5000);
             
-            // Плавная прокрутка к чату при клике на элемент оглавления
-            const tocItems = document.querySelectorAll('.toc-item');
-            
-            tocItems.forEach(item => {{
-                item.addEventListener('click', function() {{
-                    const chatNumber = this.getAttribute('data-chat');
-                    const chatElement = document.getElementById('chat-' + chatNumber);
-                    
-                    if (chatElement) {{
-                        chatElement.scrollIntoView({{
-                            behavior: 'smooth',
-                            block: 'start'
-                        }});
-                        
-                        // Подсветка чата
-                        chatElement.style.boxShadow = '0 0 0 3px rgba(102, 126, 234, 0.3)';
-                        setTimeout(() => {{
-                            chatElement.style.boxShadow = '';
-                        }}, 2000);
-                    }}
-                }});
-            }});
-            
             // Кнопка "Наверх"
             const backToTop = document.getElementById('backToTop');
             window.addEventListener('scroll', () => {{
@@ -1076,105 +3591,110 @@ def create_html_full_markdown(chats, source_filename, timestamp, cache_buster):
                 }} else {{
                     backToTop.classList.remove('visible');
                 }}
-            }});
-            
-            backToTop.addEventListener('click', function(e) {{
-                e.preventDefault();
-                document.getElementById('toc').scrollIntoView({{
-                    behavior: 'smooth',
-                    block: 'start'
-                }});
-            }});
+            }}, {{ passive: true }});
             
-            // Управление аккордеоном веток
-            const accordionHeaders = document.querySelectorAll('.accordion-header');
-            console.log('Найдено элементов аккордеона:', accordionHeaders.length);
-            
-            accordionHeaders.forEach(header => {{
-                header.addEventListener('click', function() {{
-                    console.log('Клик по аккордеону:', this.textContent);
-                    const content = this.nextElementSibling;
-                    const isActive = this.classList.contains('active');
-                    
-                    // Закрываем все аккордеоны в этой группе
-                    const parent = this.closest('.accordion-container');
-                    const allHeaders = parent.querySelectorAll('.accordion-header');
-                    const allContents = parent.querySelectorAll('.accordion-content');
-                    
-                    allHeaders.forEach(h => h.classList.remove('active'));
-                    allContents.forEach(c => {{
-                        c.classList.remove('active');
-                        c.style.maxHeight = null;
-                    }});
-                    
-                    // Открываем текущий, если был закрыт
-                    if (!isActive) {{
-                        this.classList.add('active');
-                        content.classList.add('active');
-                        content.style.maxHeight = content.scrollHeight + "px";
-                        
-                        // Подсветка открытой ветки
-                        this.parentElement.classList.add('highlight');
-                        setTimeout(() => {{
-                            this.parentElement.classList.remove('highlight');
-                        }}, 2000);
+            // Один обработчик кликов на весь документ (делегирование событий)
+            document.addEventListener('click', function(e) {{
+                const header = e.target.closest('.accordion-header');
+                if (header) {{
+                    toggleBranch(header);
+                    return;
+                }}
+                
+                const expandBtn = e.target.closest('.expand-all');
+                if (expandBtn) {{
+                    setChatBranches(expandBtn.getAttribute('data-chat'), true);
+                    return;
+                }}
+                
+                const collapseBtn = e.target.closest('.collapse-all');
+                if (collapseBtn) {{
+                    setChatBranches(collapseBtn.getAttribute('data-chat'), false);
+                    return;
+                }}
+                
+                const searchResult = e.target.closest('.search-result');
+                if (searchResult) {{
+                    e.preventDefault();
+                    history.replaceState(null, '', searchResult.getAttribute('href'));
+                    openSearchTarget(parseInt(searchResult.getAttribute('data-chat'), 10),
+                                     parseInt(searchResult.getAttribute('data-branch'), 10),
+                                     searchResult.getAttribute('data-node'));
+                    return;
+                }}
+                
+                const tocItem = e.target.closest('.toc-item');
+                if (tocItem) {{
+                    openTocItem(tocItem);
+                    return;
+                }}
+                
+                if (e.target.closest('#backToTop')) {{
+                    const toc = document.getElementById('toc');
+                    if (!toc) {{
+                        return;  // страница части экспорта - переход по ссылке
                     }}
-                }});
-            }});
-            
-            // Кнопки управления ветками
-            const expandAllBtns = document.querySelectorAll('.expand-all');
-            expandAllBtns.forEach(btn => {{
-                btn.addEventListener('click', function() {{
-                    const chatId = this.getAttribute('data-chat');
-                    const contents = document.querySelectorAll('#chat-' + chatId + ' .accordion-content');
-                    const headers = document.querySelectorAll('#chat-' + chatId + ' .accordion-header');
-                    
-                    contents.forEach(content => {{
-                        content.classList.add('active');
-                        content.style.maxHeight = content.scrollHeight + "px";
+                    e.preventDefault();
+                    toc.scrollIntoView({{
+                        behavior: 'smooth',
+                        block: 'start'
                     }});
-                    headers.forEach(header => header.classList.add('active'));
-                    
-                    console.log('Развернуты все ветки в чате', chatId);
-                }});
+                }}
             }});
             
-            const collapseAllBtns = document.querySelectorAll('.collapse-all');
-            collapseAllBtns.forEach(btn => {{
-                btn.addEventListener('click', function() {{
-                    const chatId = this.getAttribute('data-chat');
-                    const contents = document.querySelectorAll('#chat-' + chatId + ' .accordion-content');
-                    const headers = document.querySelectorAll('#chat-' + chatId + ' .accordion-header');
-                    
-                    contents.forEach(content => {{
-                        content.classList.remove('active');
-                        content.style.maxHeight = null;
-                    }});
-                    headers.forEach(header => header.classList.remove('active'));
-                    
-                    console.log('Свернуты все ветки в чате', chatId);
+            // Ответвление (branch_layout = fork) наполняется при первом раскрытии
+            document.addEventListener('toggle', function(e) {{
+                if (e.target.matches('details.fork-alt') && e.target.open) {{
+                    inflateBranch(e.target);
+                }}
+            }}, true);
+            
+            // Поле поиска (есть только на странице с индексом)
+            const searchInput = document.getElementById('searchInput');
+            if (searchInput) {{
+                let searchTimer = null;
+                searchInput.addEventListener('input', () => {{
+                    clearTimeout(searchTimer);
+                    searchTimer = setTimeout(() => showSearchResults(searchInput.value), 150);
                 }});
-            }});
+            }}
             
-            // По умолчанию открываем первую ветку в каждом чате
-            const firstAccordions = document.querySelectorAll('.accordion-container .accordion-header:first-child');
-            console.log('Открываем первые ветки:', firstAccordions.length);
+            // Ссылка вида #chat-N/ветка/узел открывает нужное сообщение
+            window.addEventListener('hashchange', openHashTarget);
+            openHashTarget();
             
-            firstAccordions.forEach(header => {{
-                if (!header.classList.contains('active')) {{
-                    setTimeout(() => {{
-                        header.click();
-                    }}, 100);
+            // По умолчанию открываем первую ветку чата, когда он
+            // приближается к области видимости (если ветка еще не выбрана)
+            const openFirstBranch = chat => {{
+                const header = chat.querySelector('.accordion-item:first-child > .accordion-header');
+                if (header && !chat.querySelector('.accordion-header.active')) {{
+                    toggleBranch(header);
                 }}
-            }});
+            }};
+            
+            const prepareChat = chat => loadChat(chat).then(openFirstBranch);
+            
+            const chats = document.querySelectorAll('.chat');
+            if ('IntersectionObserver' in window) {{
+                const observer = new IntersectionObserver(entries => {{
+                    entries.forEach(entry => {{
+                        if (entry.isIntersecting) {{
+                            observer.unobserve(entry.target);
+                            prepareChat(entry.target);
+                        }}
+                    }});
+                }}, {{ rootMargin: '200% 0px' }});
+                chats.forEach(chat => observer.observe(chat));
+            }} else {{
+                chats.forEach(prepareChat);
+            }}
             
             // Проверяем, работает ли аккордеон
             setTimeout(() => {{
                 const activeAccordions = document.querySelectorAll('.accordion-header.active');
                 console.log('Активных аккордеонов:', activeAccordions.length);
                 
-                if (activeAccordions.length === 0) {{
+                if (activeAccordions.length === 0 && document.querySelector('.accordion-header')) {{
                     console.warn('⚠️ Аккордеон не работает! Возможно проблема с кэшем.');
                     document.getElementById('cacheWarning').style.display = 'block';
                 }}
@@ -1183,28 +3703,43 @@ def create_html_full_markdown(chats, source_filename, timestamp, cache_buster):
     </script>
 </body>
 </html>'''
-    
-    return html
 
-def create_chat_with_accordion(index, chat):
-    """Создание чата с аккордеоном для веток"""
-    title = html_module.escape(chat.get('title', f'Чат {index}'))
-    
-    # Извлекаем все ветки
-    all_branches = extract_all_branches(chat)
-    organized_branches = organize_branches_by_depth(all_branches)
+def create_chat_with_accordion(index, chat, branch_layout='full', analysis=None):
+    """Создание чата с аккордеоном для веток (одной строкой)"""
+    return ''.join(iter_chat_with_accordion(index, chat, branch_layout, analysis))
+
+def iter_chat_with_accordion(index, chat, branch_layout='full', analysis=None):
+    """Создание чата с аккордеоном для веток по частям (генератор фрагментов HTML)
     
-    branches_count = len(organized_branches)
-    total_messages = sum(len(branch) for branch in organized_branches)
+    branch_layout='full' - каждая ветка содержит все свои сообщения;
+    branch_layout='shared' - общее начало выводится один раз, а ветка
+    ссылается на него и содержит только расходящийся хвост (общая часть
+    подставляется в браузере при открытии ветки);
+    branch_layout='fork' - вместо аккордеона дерево ответвлений
+    (iter_fork_view): первая ветка целиком, остальные - только хвостами
+    у сообщения, после которого они расходятся.
+    Готовый разбор чата (ChatAnalysis) можно передать через analysis.
+    """
+    if analysis is None:
+        analysis = ChatAnalysis(index, chat)
     
-    # Статистика по ролям
-    role_stats = {'user': 0, 'assistant': 0, 'unknown': 0}
-    for branch in organized_branches:
-        for msg in branch:
-            role = msg.get('role', 'unknown')
-            role_stats[role] = role_stats.get(role, 0) + 1
+    title = html_module.escape(analysis.title)
+    nodes = analysis.tree.nodes
+    organized_branches = analysis.branches
+    branches_count = analysis.branches_count
+    total_messages = analysis.total_messages
+    role_stats = analysis.role_stats
+    truncation_html = ''
+    if analysis.truncated:
+        truncation_html = (f'<div class="chat-truncated">⚠️ Чат показан не полностью '
+                           f'(settings.tree_limits): {analysis.truncation_note()}</div>')
+    fork_view = branch_layout == 'fork'
+    if fork_view:
+        branches_hint = '🔀 <strong>Ответвления показаны после сообщения, где ветки расходятся</strong>'
+    else:
+        branches_hint = '⚡ <strong>Кликайте по заголовкам веток ниже</strong> для просмотра сообщений'
     
-    html = f'''
+    yield f'''
     <div class="chat" id="chat-{index}">
         <h2>{title}</h2>
         
@@ -1217,39 +3752,54 @@ def create_chat_with_accordion(index, chat):
                 <div>🤖 Ответов DeepSeek: <strong>{role_stats.get('assistant', 0)}</strong></div>
                 <div>❓ Других: <strong>{role_stats.get('unknown', 0)}</strong></div>
             </div>
+            {truncation_html}
         </div>
         
         <div class="branches-controls">
             <button class="branch-btn expand-all" data-chat="{index}">📖 Развернуть все ветки</button>
             <button class="branch-btn secondary collapse-all" data-chat="{index}">📕 Свернуть все ветки</button>
             <div class="branches-info">
-                ⚡ <strong>Кликайте по заголовкам веток ниже</strong> для просмотра сообщений
+                {branches_hint}
             </div>
         </div>
 '''
     
+    if fork_view:
+        yield from iter_fork_view(index, analysis)
+        yield '''
+    </div>
+    '''
+        return
+    
     # Аккордеон для веток
-    html += f'''
+    yield '''
         <div class="accordion-container">
 '''
     
+    # Кэш HTML сообщений: каждый узел конвертируется один раз на чат
+    render_cache = {}
+    shared_prefixes = branch_layout == 'shared'
+    emitted_in = {}  # номер сообщения -> номер ветки, где оно уже выведено
+    
     for branch_num, branch in enumerate(organized_branches, 1):
         branch_length = len(branch)
+        content_id = f' id="branch-{index}-{branch_num}"' if shared_prefixes else ''
         
         # Статистика по ветке
-        user_messages = sum(1 for msg in branch if msg.get('role') == 'user')
-        assistant_messages = sum(1 for msg in branch if msg.get('role') == 'assistant')
-        unknown_messages = branch_length - user_messages - assistant_messages
+        branch_roles = branch.role_counts()
+        user_messages = branch_roles['user']
+        assistant_messages = branch_roles['assistant']
+        unknown_messages = branch_roles['unknown']
         
         # Первые слова первого сообщения для заголовка
         first_message_preview = ""
-        if branch and branch[0].get('content'):
-            first_words = branch[0]['content'][:80]
-            if len(branch[0]['content']) > 80:
+        if branch and branch[0].content:
+            first_words = branch[0].content[:80]
+            if len(branch[0].content) > 80:
                 first_words += "..."
             first_message_preview = html_module.escape(first_words)
         
-        html += f'''
+        yield f'''
             <div class="accordion-item">
                 <div class="accordion-header">
                     <div class="branch-info">
@@ -1266,115 +3816,852 @@ def create_chat_with_accordion(index, chat):
                     </div>
                     <div class="accordion-indicator">▼</div>
                 </div>
-                <div class="accordion-content">
+                <div class="accordion-content"{content_id}><template class="branch-body">
 '''
         
         if first_message_preview:
-            html += f'''
+            yield f'''
                     <div style="margin-bottom: 15px; padding: 10px; background: #f8f9fa; border-radius: 5px; font-size: 0.9em; color: #666;">
                         <strong>Начало ветки:</strong> {first_message_preview}
                     </div>
 '''
         
-        for j, msg in enumerate(branch, 1):
-            role = msg.get('role', 'unknown')
-            content = format_full_markdown(msg.get('content', ''))
-            node_id = msg.get('node_id', '')
-            
-            # Определяем отображение роли на основе реальных данных
-            role_display = {
-                'user': '👤 Вы',
-                'assistant': '🤖 DeepSeek',
-                'unknown': '❓ Неизвестно'
-            }.get(role, '❓ Неизвестно')
+        path = branch.indices()
+        first_position = 1
+        
+        if shared_prefixes:
+            # Общее начало уже выведено в одной из предыдущих веток -
+            # ссылаемся на нее и выводим только расходящийся хвост
+            shared_count = 0
+            for position in range(len(path), 0, -1):
+                if path[position - 1] in emitted_in:
+                    shared_count = position
+                    break
             
-            role_class = role
+            if shared_count:
+                fork = path[shared_count - 1]
+                fork_node_id = html_module.escape(str(nodes[fork].node_id))
+                source_branch = emitted_in[fork]
+                yield f'''
+                    <div class="branch-prefix-ref" data-source="branch-{index}-{source_branch}" data-count="{shared_count}">
+                        ↪ Сообщения #1–#{shared_count} совпадают с веткой #{source_branch} (до узла: {fork_node_id})
+                    </div>
+'''
+                first_position = shared_count + 1
+        
+        for j in range(first_position, len(path) + 1):
+            message_index = path[j - 1]
+            yield render_message_cached(nodes[message_index], j, render_cache)
+            if shared_prefixes:
+                emitted_in[message_index] = branch_num
+        
+        yield '''
+                </template></div>
+            </div>
+'''
+    
+    yield '''
+        </div>
+    </div>
+    '''
+
+def fork_structure(analysis):
+    """Точки ответвления веток чата (для branch_layout='fork')
+    
+    Ветки просматриваются в порядке вывода; для каждой ищется самое
+    глубокое сообщение, уже выведенное в предыдущих ветках, - общий
+    предок с ближайшей из них. Возвращает (starts, forks, roots):
+    starts[номер ветки] - сколько начальных сообщений ветки уже выведено,
+    forks[(ветка, позиция)] - ветки, ответвляющиеся после этого сообщения,
+    roots - ветки без общего начала с предыдущими (кроме первой).
+    """
+    emitted_in = {}  # номер сообщения -> номер ветки, где оно выведено
+    starts = {}
+    forks = {}
+    roots = []
+    
+    for branch_num, branch in enumerate(analysis.branches, 1):
+        path = branch.indices()
+        shared_count = 0
+        for position in range(len(path), 0, -1):
+            if path[position - 1] in emitted_in:
+                shared_count = position
+                break
+        
+        starts[branch_num] = shared_count
+        if shared_count:
+            parent = emitted_in[path[shared_count - 1]]
+            forks.setdefault((parent, shared_count), []).append(branch_num)
+        elif branch_num > 1:
+            roots.append(branch_num)
+        
+        for message_index in path[shared_count:]:
+            emitted_in[message_index] = branch_num
+    
+    return starts, forks, roots
+
+def iter_fork_view(index, analysis):
+    """Дерево ответвлений чата по частям (branch_layout='fork')
+    
+    Каждое сообщение выводится один раз: первая ветка - целиком, каждая
+    следующая - свернутым блоком <details> сразу после сообщения, где она
+    ответвляется, и только со своими сообщениями. Тело блока лежит
+    в <template> и попадает в DOM при раскрытии. Вложенные ответвления
+    обходятся через стек генераторов, без рекурсии.
+    """
+    nodes = analysis.tree.nodes
+    branches = analysis.branches
+    starts, forks, roots = fork_structure(analysis)
+    render_cache = {}
+    
+    # Ветки поддерева каждого блока: по ним браузер находит нужную ветку
+    # в свернутых блоках (переход из поиска, ссылки #chat-N/ветка/узел)
+    subtree = {branch_num: [branch_num] for branch_num in range(1, len(branches) + 1)}
+    parents = {child: parent for (parent, _), children in forks.items() for child in children}
+    for branch_num in range(len(branches), 0, -1):
+        if branch_num in parents:
+            subtree[parents[branch_num]].extend(subtree[branch_num])
+    
+    def segment(branch_num):
+        # Фрагменты HTML ветки; номер ветки вместо строки - вложенный блок
+        path = branches[branch_num - 1].indices()
+        first_position = starts[branch_num] + 1
+        
+        if branch_num > 1:
+            # Статистика хвоста - разность префиксных счетчиков листа и точки ответвления
+            tree = analysis.tree
+            leaf = path[-1]
+            suffix_length = len(path) - first_position + 1
+            users, assistants = tree.users[leaf], tree.assistants[leaf]
+            if first_position > 1:
+                fork_index = path[first_position - 2]
+                users -= tree.users[fork_index]
+                assistants -= tree.assistants[fork_index]
             
-            html += f'''
-                    <div class="message {role_class}">
+            anchor = f'после сообщения #{first_position - 1}' if first_position > 1 else 'с начала диалога'
+            preview = ''
+            if suffix_length:
+                first_content = nodes[path[first_position - 1]].content
+                first_words = first_content[:80]
+                if len(first_content) > 80:
+                    first_words += "..."
+                preview = f'<span class="fork-alt-preview">{html_module.escape(first_words)}</span>'
+            yield f'''
+                <details class="fork-alt" data-branch="{branch_num}" data-branches="{' '.join(map(str, subtree[branch_num]))}">
+                    <summary>
+                        <span class="fork-alt-title">🔀 Ветка #{branch_num}</span>
+                        <span class="branch-stats">
+                            <span title="Точка ответвления">↳ {anchor}</span>
+                            <span title="Новых сообщений">📝 {suffix_length}</span>
+                            <span title="Сообщений пользователя">👤 {users}</span>
+                            <span title="Ответов DeepSeek">🤖 {assistants}</span>
+                        </span>
+                        {preview}
+                    </summary>
+                    <template class="branch-body">
+'''
+        
+        for position in range(first_position, len(path) + 1):
+            yield render_message_cached(nodes[path[position - 1]], position, render_cache)
+            alternatives = forks.get((branch_num, position))
+            if alternatives:
+                yield '''
+                <div class="fork-point">
+'''
+                yield from alternatives
+                yield '''
+                </div>
+'''
+        
+        if branch_num > 1:
+            yield '''
+                    </template>
+                </details>
+'''
+    
+    def root_alternatives():
+        # Ветки, которые расходятся с первой уже на первом сообщении
+        yield '''
+            <div class="fork-point fork-roots">
+'''
+        yield from roots
+        yield '''
+            </div>
+'''
+    
+    yield f'''
+        <div class="fork-view">
+            <div class="fork-trunk-note">🌳 Ветка #1: {len(branches[0]) if branches else 0} сообщений, ответвлений: {max(len(branches) - 1, 0)}</div>
+'''
+    
+    stack = []
+    if roots:
+        stack.append(root_alternatives())
+    if branches:
+        stack.append(segment(1))
+    while stack:
+        part = next(stack[-1], None)
+        if part is None:
+            stack.pop()
+        elif isinstance(part, int):
+            stack.append(segment(part))
+        else:
+            yield part
+    
+    yield '''
+        </div>
+'''
+
+ROLE_DISPLAY = {
+    'user': '👤 Вы',
+    'assistant': '🤖 DeepSeek',
+    'unknown': '❓ Неизвестно'
+}
+
+
+def content_digest(content):
+    """Короткий хэш содержимого сообщения"""
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def render_message(msg, position):
+    """HTML одного сообщения ветки"""
+    role = html_module.escape(str(msg.role))
+    if _profiler is None:
+        content = cached_fragment('markdown', msg.content, format_full_markdown, msg.content)
+    else:
+        started = time.perf_counter()
+        content = cached_fragment('markdown', msg.content, format_full_markdown, msg.content)
+        _profiler.add('markdown', time.perf_counter() - started, 1, len(content))
+    node_id = html_module.escape(str(msg.node_id))
+    
+    # Определяем отображение роли на основе реальных данных
+    role_display = ROLE_DISPLAY.get(msg.role, '❓ Неизвестно')
+    
+    return f'''
+                    <div class="message {role}" data-node="{node_id}">
                         <div class="message-header">
                             <div class="message-role">
                                 <span>{role_display}</span>
-                                <span class="message-id">#{j} (узел: {node_id})</span>
+                                <span class="message-id">#{position} (узел: {node_id})</span>
                             </div>
                         </div>
                         <div class="message-content">{content}</div>
                     </div>
 '''
-        
-        html += '''
-                </div>
-            </div>
-'''
+
+
+def render_message_cached(msg, position, cache):
+    """render_message с кэшем по номеру сообщения в дереве и позиции"""
+    key = (msg.index, position)
+    html = cache.get(key)
+    if html is None:
+        html = render_message(msg, position)
+        cache[key] = html
+    return html
+
+
+# Текст короче этого рендерится быстрее, чем ищется в кэше фрагментов
+RENDER_CACHE_MIN_CHARS = 128
+# Новые фрагменты копятся в памяти до записи на диск не больше этого объема
+RENDER_CACHE_PENDING_BYTES = 8 * 1024 * 1024
+
+
+class RenderCache:
+    """LRU-кэш HTML фрагментов Markdown по хэшу текста (с копией в sqlite3 при path)"""
     
-    html += '''
-        </div>
-    </div>
-    '''
+    def __init__(self, max_bytes, path=None, max_disk_bytes=0):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.max_disk_bytes = max_disk_bytes
+        self.size = 0
+        self._entries = {}  # ключ -> HTML, от давно использованных к недавним
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+        self._new = {}
+        self._new_size = 0
+        self._used = set()
+    
+    @staticmethod
+    def key(kind, text):
+        """Ключ фрагмента: хэш текста с видом фрагмента в качестве персонализации"""
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16, person=kind.encode('ascii')).digest()
+    
+    def get(self, key):
+        """HTML фрагмента или None"""
+        with self._lock:
+            html = self._entries.pop(key, None)
+            if html is not None:
+                self._entries[key] = html
+            elif self.path is not None:
+                row = self._connect().execute("SELECT html FROM fragments WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    html = row[0]
+                    self._remember(key, html)
+            if html is not None and self.path is not None:
+                self._used.add(key)
+            return html
+    
+    def put(self, key, html):
+        with self._lock:
+            self._remember(key, html)
+            if self.path is not None:
+                self._new[key] = html
+                self._new_size += sys.getsizeof(html)
+                if self._new_size > RENDER_CACHE_PENDING_BYTES:
+                    self._write()
+    
+    def _remember(self, key, html):
+        size = sys.getsizeof(html)
+        if size > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.size -= sys.getsizeof(previous)
+        self._entries[key] = html
+        self.size += size
+        while self.size > self.max_bytes:
+            self.size -= sys.getsizeof(self._entries.pop(next(iter(self._entries))))
     
+    def _connect(self):
+        # Воркер пула после fork открывает свое соединение вместо унаследованного
+        if self._db is None or self._db_pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute('''CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY, value TEXT)''')
+            signature = code_signature()
+            row = db.execute("SELECT value FROM meta WHERE key = 'signature'").fetchone()
+            if row is None or row[0] != signature:
+                db.execute("DROP TABLE IF EXISTS fragments")
+                db.execute("INSERT OR REPLACE INTO meta VALUES ('signature', ?)", (signature,))
+            db.execute('''CREATE TABLE IF NOT EXISTS fragments (
+                key BLOB PRIMARY KEY, html TEXT, size INTEGER, used INTEGER)''')
+            db.commit()
+            self._db = db
+            self._db_pid = os.getpid()
+        return self._db
+    
+    def _write(self):
+        db = self._connect()
+        now = int(time.time())
+        db.executemany("INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?)",
+                       [(key, html, len(html.encode('utf-8')), now) for key, html in self._new.items()])
+        db.executemany("UPDATE fragments SET used = ? WHERE key = ?",
+                       [(now, key) for key in self._used if key not in self._new])
+        db.commit()
+        self._new.clear()
+        self._new_size = 0
+        self._used.clear()
+    
+    def flush(self, trim=False):
+        """Запись новых фрагментов на диск; trim - удаление давно не
+        использованных записей сверх max_disk_bytes"""
+        if self.path is None:
+            return
+        with self._lock:
+            self._write()
+            if trim and self.max_disk_bytes > 0:
+                self._db.execute('''DELETE FROM fragments WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY used DESC, rowid DESC) AS total
+                        FROM fragments)
+                    WHERE total > ?)''', (self.max_disk_bytes,))
+                self._db.commit()
+    
+    def close(self):
+        with self._lock:
+            if self._db is not None and self._db_pid == os.getpid():
+                self._db.close()
+            self._db = None
+
+
+def cached_fragment(kind, text, render, *args):
+    """render(*args) через кэш фрагментов по виду kind и исходному тексту text"""
+    cache = _render_cache
+    if cache is None or len(text) < RENDER_CACHE_MIN_CHARS:
+        return render(*args)
+    
+    key = cache.key(kind, text)
+    html = cache.get(key)
+    if _profiler is not None:
+        _profiler.add_cache(kind, html is not None, html is None)
+    if html is None:
+        html = render(*args)
+        cache.put(key, html)
     return html
 
-def format_full_markdown(content):
-    """Полная обработка Markdown с поддержкой таблиц, подзаголовков и фрагментов кода"""
-    if not content:
-        return ""
+
+# Поисковый индекс: слова из букв и цифр любого алфавита (кириллица,
+# латиница), в нижнем регистре, ё приравнивается к е
+_TOKEN_RE = re.compile(r'[^\W_]+')
+_SPACES_RE = re.compile(r'\s+')
+
+SEARCH_MIN_TOKEN_LENGTH = 2
+SEARCH_MAX_TOKEN_LENGTH = 40
+SEARCH_PREVIEW_LENGTH = 120
+SEARCH_ROLE_CODES = {'user': 'u', 'assistant': 'a'}
+
+
+def search_tokens(text):
+    """Уникальные слова текста для поискового индекса"""
+    tokens = set(_TOKEN_RE.findall(text.lower().replace('ё', 'е')))
+    return [token for token in tokens
+            if SEARCH_MIN_TOKEN_LENGTH <= len(token) <= SEARCH_MAX_TOKEN_LENGTH]
+
+def chat_search_entries(analysis):
+    """Данные чата для поискового индекса: заголовок и записи сообщений
+    
+    Каждое сообщение индексируется один раз - в первой ветке, где оно
+    встречается (в режимах shared и fork именно там оно и выведено). Запись:
+    [номер ветки, node_id, код роли, начало текста, слова].
+    """
+    if _profiler is not None:
+        started = time.perf_counter()
+    
+    entries = []
+    nodes = analysis.tree.nodes
+    seen = bytearray(len(nodes))
+    for branch_num, branch in enumerate(analysis.branches, 1):
+        for index in branch.indices():
+            if seen[index]:
+                continue
+            seen[index] = 1
+            msg = nodes[index]
+            content = msg.content
+            preview = _SPACES_RE.sub(' ', content[:SEARCH_PREVIEW_LENGTH * 2]).strip()[:SEARCH_PREVIEW_LENGTH]
+            entries.append([branch_num, msg.node_id, SEARCH_ROLE_CODES.get(msg.role, ''),
+                            preview, search_tokens(content)])
+    
+    if _profiler is not None:
+        _profiler.add('search', time.perf_counter() - started, 1, len(entries))
+    return analysis.title, entries
+
+
+class SearchIndex:
+    """Инвертированный индекс сообщений, встраиваемый в страницу экспорта
+    
+    Накапливается по мере записи чатов. В странице хранится как JSON:
+    titles - заголовки чатов, docs - [чат, ветка, node_id, роль, начало
+    текста], terms - отсортированные слова, postings - номера docs для
+    каждого слова в виде разностей соседних номеров.
+    """
+    
+    def __init__(self):
+        self.titles = []
+        self.docs = []
+        self.terms = {}
+        self._sorted_terms = None
+    
+    def add_title(self, index, title):
+        # Номера чатов идут подряд с 1, заголовок ищется по номеру
+        while len(self.titles) < index:
+            self.titles.append('')
+        self.titles[index - 1] = title
+    
+    def add_chat(self, index, search_data):
+        title, entries = search_data
+        self._sorted_terms = None
+        self.add_title(index, title)
+        
+        for branch_num, node_id, role, preview, tokens in entries:
+            doc = len(self.docs)
+            self.docs.append([index, branch_num, node_id, role, preview])
+            for token in tokens:
+                postings = self.terms.get(token)
+                if postings is None:
+                    self.terms[token] = [doc]
+                else:
+                    postings.append(doc)
+    
+    def search(self, query):
+        """Номера docs сообщений, содержащих все слова запроса (каждое - как
+        начало слова); то же, что runSearch на странице экспорта"""
+        tokens = [token for token in _TOKEN_RE.findall(query.lower().replace('ё', 'е'))
+                  if len(token) >= SEARCH_MIN_TOKEN_LENGTH]
+        if not tokens:
+            return []
+        terms = self._sorted_terms
+        if terms is None:
+            terms = self._sorted_terms = sorted(self.terms)
+        
+        result = None
+        for token in tokens:
+            docs = set()
+            start = bisect.bisect_left(terms, token)
+            end = bisect.bisect_left(terms, token + '\U0010ffff', start)
+            for term in terms[start:end]:
+                postings = self.terms[term]
+                docs.update(postings if result is None else [doc for doc in postings if doc in result])
+            result = docs
+            if not result:
+                break
+        return sorted(result)
+    
+    def to_json(self):
+        # Порядок как у сравнения строк в JavaScript (по кодам UTF-16)
+        terms = sorted(self.terms, key=lambda term: term.encode('utf-16-be'))
+        postings = []
+        for term in terms:
+            previous = 0
+            deltas = []
+            for doc in self.terms[term]:
+                deltas.append(doc - previous)
+                previous = doc
+            postings.append(deltas)
+        
+        data = {'v': 1, 'titles': self.titles, 'docs': self.docs, 'terms': terms, 'postings': postings}
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    
+    def iter_json(self):
+        """JSON индекса по частям (части не разрезают строки JSON)"""
+        yield self.to_json()
+    
+    def write(self, out, compress=False):
+        """Запись индекса в страницу (см. write_search_index)"""
+        write_search_index(out, self.iter_json(), compress)
+
+
+# Символы разметки внутри JSON в <script>: </script> закрыл бы тег, а <!--
+# перевел бы парсер HTML в режим, где тег не закрывается. В строках JSON
+# они заменяются на \uXXXX, вне строк JSON они не встречаются
+_SCRIPT_JSON_ESCAPES = str.maketrans({'<': '\\u003c', '>': '\\u003e', '&': '\\u0026'})
+
+
+def write_search_index(out, chunks, compress=False):
+    """Запись JSON индекса из частей chunks в страницу (<script type="application/json">,
+    при compress - zlib + base64 с data-encoding="deflate")"""
+    if _profiler is not None:
+        started = time.perf_counter()
+    
+    if compress:
+        out.write('\n    <script type="application/octet-stream" id="search-index" data-encoding="deflate">')
+        size = write_deflate_base64(out, chunks)
+    else:
+        out.write('\n    <script type="application/json" id="search-index">')
+        size = 0
+        for chunk in chunks:
+            chunk = chunk.translate(_SCRIPT_JSON_ESCAPES)
+            out.write(chunk)
+            size += len(chunk)
+    out.write('</script>\n')
+    
+    if _profiler is not None:
+        _profiler.add('search_index', time.perf_counter() - started, 1, size)
+
+
+# Размер частей JSON, которые SpooledSearchIndex отдает при записи, и
+# число пар (слово, запись), после которого списки пишутся на диск
+SEARCH_SPOOL_CHUNK_CHARS = 64 * 1024
+SEARCH_SPOOL_BATCH_POSTINGS = 200000
+
+
+class SpooledSearchIndex:
+    """Поисковый индекс экспорта, накапливаемый во временной базе sqlite3
+    
+    Записи сообщений уходят на диск сразу, а списки записей по словам -
+    пачками по SEARCH_SPOOL_BATCH_POSTINGS пар (одна строка на слово
+    в пачке). Словарь сортирует SQLite, JSON выводится в страницу по
+    частям, поэтому память экспорта не растет с объемом индекса. Слово
+    хранится ключом в UTF-16 BE: порядок байтов совпадает с порядком
+    строк в JavaScript. Результат совпадает с SearchIndex.to_json.
+    """
+    
+    def __init__(self):
+        self.titles = []
+        self.terms = {}  # списки записей по словам, еще не записанные на диск
+        self._doc_count = 0
+        self._batch = 0
+        self._pending = 0
+        # Пустое имя - временная база SQLite, удаляется при закрытии
+        self._db = sqlite3.connect('')
+        self._db.execute("CREATE TABLE docs (doc INTEGER PRIMARY KEY, data TEXT)")
+        self._db.execute("CREATE TABLE postings (term_key BLOB, batch INTEGER, docs TEXT)")
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def close(self):
+        self._db.close()
+    
+    def add_title(self, index, title):
+        while len(self.titles) < index:
+            self.titles.append('')
+        self.titles[index - 1] = title
     
-    # 1. Заменяем переносы строк на <br> для сохранения структуры
-    content = content.replace('\n', '<br>')
+    def add_chat(self, index, search_data):
+        title, entries = search_data
+        self.add_title(index, title)
+        
+        docs = []
+        for branch_num, node_id, role, preview, tokens in entries:
+            doc = self._doc_count
+            self._doc_count += 1
+            docs.append((doc, json.dumps([index, branch_num, node_id, role, preview],
+                                         ensure_ascii=False, separators=(',', ':'))))
+            for token in tokens:
+                postings = self.terms.get(token)
+                if postings is None:
+                    self.terms[token] = [doc]
+                else:
+                    postings.append(doc)
+            self._pending += len(tokens)
+        self._db.executemany("INSERT INTO docs VALUES (?, ?)", docs)
+        if self._pending >= SEARCH_SPOOL_BATCH_POSTINGS:
+            self._write_postings()
     
-    # 2. Обрабатываем блоки кода с языком
-    content = re.sub(
-        r'```(\w+)?<br>([\s\S]*?)<br>```',
-        lambda m: create_code_block(m.group(2), m.group(1)),
-        content
-    )
+    def _write_postings(self):
+        self._db.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                             [(term.encode('utf-16-be'), self._batch, ','.join(map(str, docs)))
+                              for term, docs in self.terms.items()])
+        self.terms.clear()
+        self._batch += 1
+        self._pending = 0
     
-    # 3. Обрабатываем блоки кода без указания языка
-    content = re.sub(
-        r'```<br>([\s\S]*?)<br>```',
-        lambda m: create_code_block(m.group(1), ''),
-        content
-    )
+    def to_json(self):
+        return ''.join(self.iter_json())
+    
+    def iter_json(self):
+        db = self._db
+        if self.terms:
+            self._write_postings()
+        db.execute("CREATE INDEX IF NOT EXISTS postings_term ON postings (term_key, batch)")
+        parts = []
+        size = 0
+        
+        def emit(text):
+            nonlocal size
+            parts.append(text)
+            size += len(text)
+            return size >= SEARCH_SPOOL_CHUNK_CHARS
+        
+        def flush():
+            nonlocal size
+            chunk = ''.join(parts)
+            parts.clear()
+            size = 0
+            return chunk
+        
+        emit('{"v":1,"titles":' + json.dumps(self.titles, ensure_ascii=False, separators=(',', ':'))
+             + ',"docs":[')
+        separator = ''
+        for (data,) in db.execute("SELECT data FROM docs ORDER BY doc"):
+            if emit(separator + data):
+                yield flush()
+            separator = ','
+        
+        emit('],"terms":[')
+        separator = ''
+        for (term_key,) in db.execute("SELECT DISTINCT term_key FROM postings ORDER BY term_key"):
+            if emit(separator + json.dumps(term_key.decode('utf-16-be'), ensure_ascii=False)):
+                yield flush()
+            separator = ','
+        
+        emit('],"postings":[')
+        separator = ''
+        current = None
+        previous = 0
+        deltas = []
+        for term_key, docs in db.execute("SELECT term_key, docs FROM postings ORDER BY term_key, batch"):
+            if term_key != current:
+                if current is not None:
+                    if emit(separator + '[' + ','.join(deltas) + ']'):
+                        yield flush()
+                    separator = ','
+                current = term_key
+                previous = 0
+                deltas = []
+            for doc in map(int, docs.split(',')):
+                deltas.append(str(doc - previous))
+                previous = doc
+        if current is not None:
+            emit(separator + '[' + ','.join(deltas) + ']')
+        emit(']}')
+        yield flush()
     
-    # 4. Обрабатываем инлайн код
-    content = re.sub(r'`([^`]+)`', r'<code>\1</code>', content)
+    def write(self, out, compress=False):
+        """Запись индекса в страницу (см. write_search_index)"""
+        write_search_index(out, self.iter_json(), compress)
+
+
+SEARCH_BOX = '''        <div class="search-box">
+            <input type="search" id="searchInput" placeholder="🔍 Поиск по сообщениям всех чатов..." autocomplete="off">
+            <div class="search-status" id="searchStatus"></div>
+            <div class="search-results" id="searchResults"></div>
+        </div>
+        
+'''
+
+
+# Предкомпилированные шаблоны Markdown
+_HEADING_RE = re.compile(r'(#{1,6})\s+(.+?)\s*#*\s*$')
+_HR_RE = re.compile(r'(?:-{3,}|\*{3,}|_{3,})$')
+_BULLET_RE = re.compile(r'[*+-]\s+(.*)$')
+_ORDERED_RE = re.compile(r'\d+[.)]\s+(.*)$')
+_FENCE_RE = re.compile(r'(`{3,})\s*([\w+#.-]*)')
+_TABLE_SEPARATOR_RE = re.compile(r'\|?\s*:?-+:?\s*(?:\|\s*:?-+:?\s*)*\|?$')
+_INLINE_TRIGGER_RE = re.compile(r'[`\[*_~]')
+_INLINE_RE = re.compile(r'''
+      `(?P<code>[^`]+)`
+    | \[(?P<link_text>[^\]]+)\]\((?P<link_url>[^)\s]+)\)
+    | \*\*\*(?P<strong_em>[^\s*](?:.*?[^\s*])?)\*\*\*
+    | (?<!\w)___(?P<strong_em_alt>[^\s_](?:.*?[^\s_])?)___(?!\w)
+    | \*\*(?P<strong>.+?)\*\*
+    | (?<!\w)__(?P<strong_alt>.+?)__(?!\w)
+    | ~~(?P<del>.+?)~~
+    | \*(?P<em>[^\s*](?:.*?[^\s*])?)\*
+    | (?<!\w)_(?P<em_alt>[^\s_](?:.*?[^\s_])?)_(?!\w)
+''', re.VERBOSE)
+_SAFE_URL_RE = re.compile(r'(?:https?:|mailto:|ftp:|#|/|\./|\.\./)|[^:]*$', re.IGNORECASE)
+
+
+def format_full_markdown(content):
+    """Полная обработка Markdown с поддержкой таблиц, подзаголовков и фрагментов кода
     
-    # 5. Обрабатываем заголовки
-    content = re.sub(r'###\s+(.+?)(?:<br>|$)', r'<h5>\1</h5>', content)
-    content = re.sub(r'##\s+(.+?)(?:<br>|$)', r'<h4>\1</h4>', content)
-    content = re.sub(r'#\s+(.+?)(?:<br>|$)', r'<h3>\1</h3>', content)
+    Однопроходный разбор: блочный токенизатор идет по строкам (блоки кода,
+    заголовки, списки, таблицы, линии, абзацы), а текст внутри блоков
+    обрабатывает инлайн-токенизатор. Обычный текст экранируется.
+    """
+    if not content:
+        return ""
     
-    # 6. Обрабатываем жирный текст
-    content = re.sub(r'\*\*(.+?)\*\*', r'<strong>\1</strong>', content)
-    content = re.sub(r'__(.+?)__', r'<strong>\1</strong>', content)
+    lines = content.split('\n')
+    line_count = len(lines)
+    output = []
+    text_lines = []  # строки текущего абзаца (соединяются через <br>)
     
-    # 7. Обрабатываем курсив
-    content = re.sub(r'\*(.+?)\*', r'<em>\1</em>', content)
-    content = re.sub(r'_(.+?)_', r'<em>\1</em>', content)
+    def flush_text():
+        if text_lines:
+            output.append('<br>'.join(text_lines))
+            text_lines.clear()
     
-    # 8. Обрабатываем зачеркнутый текст
-    content = re.sub(r'~~(.+?)~~', r'<del>\1</del>', content)
+    i = 0
+    while i < line_count:
+        line = lines[i]
+        stripped = line.strip()
+        
+        if not stripped:
+            text_lines.append('')
+            i += 1
+            continue
+        
+        first = stripped[0]
+        
+        # Блок кода
+        if first == '`' and stripped.startswith('```'):
+            fence_match = _FENCE_RE.match(stripped)
+            fence = fence_match.group(1)
+            language = fence_match.group(2)
+            code_lines = []
+            i += 1
+            while i < line_count:
+                closing = lines[i].strip()
+                if closing.startswith(fence) and not closing.strip('`'):
+                    break
+                code_lines.append(lines[i])
+                i += 1
+            flush_text()
+            code = '\n'.join(code_lines)
+            output.append(cached_fragment('code_block', f'{language}\n{code}', create_code_block, code, language))
+            i += 1
+            continue
+        
+        # Заголовки: # -> h3, ## -> h4, ### и глубже -> h5
+        if first == '#':
+            heading_match = _HEADING_RE.match(stripped)
+            if heading_match:
+                level = min(len(heading_match.group(1)) + 2, 5)
+                flush_text()
+                output.append(f'<h{level}>{format_inline(heading_match.group(2))}</h{level}>')
+                i += 1
+                continue
+        
+        # Горизонтальная линия
+        if first in '-*_' and _HR_RE.match(stripped):
+            flush_text()
+            output.append('<hr>')
+            i += 1
+            continue
+        
+        # Списки
+        if first in '*+-' or first.isdigit():
+            list_type = 'ul' if first in '*+-' else 'ol'
+            item_re = _BULLET_RE if list_type == 'ul' else _ORDERED_RE
+            items = []
+            while i < line_count:
+                item_match = item_re.match(lines[i].strip())
+                if not item_match:
+                    break
+                items.append(f'<li>{format_inline(item_match.group(1).strip())}</li>')
+                i += 1
+            if items:
+                flush_text()
+                output.append(f'<{list_type}>' + ''.join(items) + f'</{list_type}>')
+                continue
+        
+        # Таблица: строка с '|' и строка-разделитель под ней
+        if ('|' in stripped and i + 1 < line_count and '|' in lines[i + 1]
+                and _TABLE_SEPARATOR_RE.match(lines[i + 1].strip())):
+            table_end = i + 2
+            while table_end < line_count and '|' in lines[table_end]:
+                table_end += 1
+            flush_text()
+            output.append(convert_table(lines[i:table_end]))
+            i = table_end
+            continue
+        
+        text_lines.append(format_inline(line))
+        i += 1
     
-    # 9. Обрабатываем ссылки
-    content = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'<a href="\2" target="_blank">\1</a>', content)
+    flush_text()
+    return ''.join(output)
+
+
+def format_inline(text):
+    """Инлайн-разметка: код, ссылки, жирный, курсив, зачеркнутый"""
+    if not _INLINE_TRIGGER_RE.search(text):
+        return html_module.escape(text, quote=False)
     
-    # 10. Обрабатываем списки (упрощенная версия)
-    content = process_lists_simple(content)
+    parts = []
+    last_end = 0
     
-    # 11. Обрабатываем таблицы
-    content = process_markdown_tables_simple(content)
+    for match in _INLINE_RE.finditer(text):
+        start = match.start()
+        if start > last_end:
+            parts.append(html_module.escape(text[last_end:start], quote=False))
+        last_end = match.end()
+        
+        kind = match.lastgroup
+        if kind == 'code':
+            parts.append(f'<code>{html_module.escape(match.group("code"), quote=False)}</code>')
+        elif kind == 'link_url':
+            url = match.group('link_url')
+            label = format_inline(match.group('link_text'))
+            if _SAFE_URL_RE.match(url):
+                parts.append(f'<a href="{html_module.escape(url)}" target="_blank">{label}</a>')
+            else:
+                parts.append(f'[{label}]({html_module.escape(url, quote=False)})')
+        elif kind in ('strong_em', 'strong_em_alt'):
+            parts.append(f'<strong><em>{format_inline(match.group(kind))}</em></strong>')
+        elif kind in ('strong', 'strong_alt'):
+            parts.append(f'<strong>{format_inline(match.group(kind))}</strong>')
+        elif kind == 'del':
+            parts.append(f'<del>{format_inline(match.group("del"))}</del>')
+        else:
+            parts.append(f'<em>{format_inline(match.group(kind))}</em>')
     
-    # 12. Обрабатываем горизонтальные линии
-    content = content.replace('---', '<hr>')
-    content = content.replace('***', '<hr>')
+    if last_end < len(text):
+        parts.append(html_module.escape(text[last_end:], quote=False))
     
-    return content
+    return ''.join(parts)
 
 def create_code_block(code, language):
     """Создание блока кода с кнопкой копирования"""
-    # Восстанавливаем переносы строк
-    code = code.replace('<br>', '\n')
-    
     # Определяем язык для отображения
     lang_display = {
         'python': 'Python',
@@ -1407,6 +4694,8 @@ def create_code_block(code, language):
     
     # Экранируем HTML в коде
     escaped_code = html_module.escape(code)
+    language = html_module.escape(language or '')
+    lang_display = html_module.escape(lang_display)
     
     return f'''
     <div class="code-block-container">
@@ -1423,135 +4712,149 @@ def create_code_block(code, language):
     </div>
     '''
 
-def process_lists_simple(content):
-    """Упрощенная обработка списков"""
-    lines = content.split('<br>')
-    result = []
-    in_list = False
-    list_type = None  # 'ul' или 'ol'
-    list_items = []
-    
-    for line in lines:
-        line_stripped = line.strip()
-        
-        # Проверяем маркированный список
-        if line_stripped.startswith(('* ', '- ', '+ ')):
-            if not in_list:
-                in_list = True
-                list_type = 'ul'
-            # Извлекаем содержимое элемента
-            item_content = line_stripped[2:].strip()
-            list_items.append(f'<li>{item_content}</li>')
-        
-        # Проверяем нумерованный список
-        elif re.match(r'^\d+\.\s+', line_stripped):
-            if not in_list:
-                in_list = True
-                list_type = 'ol'
-            # Извлекаем содержимое элемента
-            item_content = re.sub(r'^\d+\.\s+', '', line_stripped)
-            list_items.append(f'<li>{item_content}</li>')
-        
-        else:
-            # Если мы были в списке, закрываем его
-            if in_list:
-                result.append(f'<{list_type}>' + ''.join(list_items) + f'</{list_type}>')
-                in_list = False
-                list_type = None
-                list_items = []
-            
-            result.append(line)
-    
-    # Если остался незакрытый список
-    if in_list:
-        result.append(f'<{list_type}>' + ''.join(list_items) + f'</{list_type}>')
-    
-    return '<br>'.join(result)
-
-def process_markdown_tables_simple(content):
-    """Упрощенная обработка Markdown таблиц"""
-    lines = content.split('<br>')
-    result = []
-    i = 0
-    
-    while i < len(lines):
-        # Проверяем, является ли текущая строка началом таблицы
-        if '|' in lines[i] and i + 1 < len(lines) and '|' in lines[i + 1]:
-            # Проверяем, является ли следующая строка разделителем
-            next_line = lines[i + 1]
-            if re.search(r'[-:|]', next_line):
-                # Нашли таблицу
-                table_start = i
-                # Ищем конец таблицы
-                table_end = i + 1
-                while table_end < len(lines) and '|' in lines[table_end]:
-                    table_end += 1
-                
-                # Извлекаем строки таблицы
-                table_lines = lines[table_start:table_end]
-                table_html = convert_table_simple(table_lines)
-                result.append(table_html)
-                i = table_end
-                continue
-        
-        result.append(lines[i])
-        i += 1
-    
-    return '<br>'.join(result)
-
-def convert_table_simple(table_lines):
-    """Конвертация простой таблицы"""
-    if len(table_lines) < 2:
-        return ""
-    
-    # Парсим строки
-    parsed_rows = []
-    for line in table_lines:
-        # Убираем начальные и конечные '|'
-        cleaned = line.strip().strip('|')
-        # Разделяем на ячейки
-        cells = [cell.strip() for cell in cleaned.split('|')]
-        parsed_rows.append(cells)
+def convert_table(table_lines):
+    """Конвертация Markdown таблицы (заголовок, разделитель, строки данных)"""
+    # Парсим строки: убираем крайние '|' и разделяем на ячейки
+    parsed_rows = [[cell.strip() for cell in line.strip().strip('|').split('|')]
+                   for line in table_lines]
     
     # Определяем выравнивание на основе разделительной строки
     alignments = []
-    if len(parsed_rows) >= 2:
-        separator_row = parsed_rows[1]
-        for cell in separator_row:
-            if cell.startswith(':') and cell.endswith(':'):
-                alignments.append('center')
-            elif cell.endswith(':'):
-                alignments.append('right')
-            else:
-                alignments.append('left')
+    for cell in parsed_rows[1]:
+        if cell.startswith(':') and cell.endswith(':'):
+            alignments.append('center')
+        elif cell.endswith(':'):
+            alignments.append('right')
+        else:
+            alignments.append('left')
+    
+    headers = parsed_rows[0]
+    column_aligns = [alignments[j] if j < len(alignments) else 'left' for j in range(len(headers))]
     
-    html = '<div class="markdown-table-container"><table class="markdown-table"><thead><tr>'
+    parts = ['<div class="markdown-table-container"><table class="markdown-table"><thead><tr>']
     
     # Заголовки (первая строка)
-    headers = parsed_rows[0]
-    for j, header in enumerate(headers):
-        align = alignments[j] if j < len(alignments) else 'left'
-        html += f'<th style="text-align: {align}">{header}</th>'
+    for header, align in zip(headers, column_aligns):
+        parts.append(f'<th style="text-align: {align}">{format_inline(header)}</th>')
     
-    html += '</tr></thead><tbody>'
+    parts.append('</tr></thead><tbody>')
     
     # Данные (начиная с третьей строки)
-    for k in range(2, len(parsed_rows)):
-        cells = parsed_rows[k]
-        html += '<tr>'
-        
-        for j in range(len(headers)):
+    for cells in parsed_rows[2:]:
+        parts.append('<tr>')
+        for j, align in enumerate(column_aligns):
             cell = cells[j] if j < len(cells) else ''
-            align = alignments[j] if j < len(alignments) else 'left'
-            html += f'<td style="text-align: {align}">{cell}</td>'
-        
-        html += '</tr>'
+            parts.append(f'<td style="text-align: {align}">{format_inline(cell)}</td>')
+        parts.append('</tr>')
     
-    html += '</tbody></table></div>'
+    parts.append('</tbody></table></div>')
     
-    return html
+    return ''.join(parts)
 
-if __name__ == "__main__":
+def parse_args(argv=None):
+    """Аргументы командной строки"""
+    parser = argparse.ArgumentParser(description="Экспорт чатов DeepSeek в HTML")
+    parser.add_argument('inputs', nargs='*', metavar='input',
+                        help="JSON файлы, папки или glob-шаблоны (в кавычках); без них - "
+                             "интерактивный выбор файла, с ними - пакетный режим без вопросов")
+    parser.add_argument('-o', '--output', metavar='PATH',
+                        help="путь результата (для нескольких файлов - папка)")
+    parser.add_argument('-f', '--format', dest='output_format', choices=OUTPUT_FORMATS, default='html',
+                        help="формат результата")
+    parser.add_argument('--summary', metavar='FILE',
+                        help="файл JSON со сводкой пакетного запуска (для нескольких файлов "
+                             "по умолчанию export_summary_дата_время.json в папке результатов)")
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="не выводить ничего, кроме ошибок")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="число процессов для рендеринга чатов (0 - по числу ядер)")
+    parser.add_argument('--shard-size', type=int, default=0, metavar='N',
+                        help="экспорт в папку: index.html и отдельный файл на каждые N чатов")
+    parser.add_argument('--profile', action='store_true',
+                        help="вывести время, число вызовов и объем по этапам и самые медленные чаты")
+    parser.add_argument('--profile-top', type=int, default=10, metavar='N',
+                        help="сколько самых медленных чатов показать в профиле")
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help="сохранить статистику cProfile (pstats) в файл")
+    parser.add_argument('--search-index', action='store_const', const=True, default=None,
+                        help="встроить в страницу поисковый индекс и поле поиска (по умолчанию из config.json)")
+    parser.add_argument('--no-search-index', dest='search_index', action='store_const', const=False,
+                        help="не строить поисковый индекс")
+    parser.add_argument('--compress-payload', action='store_const', const=True, default=None,
+                        help="хранить чаты и поисковый индекс сжатыми (zlib + base64), "
+                             "браузер распаковывает их при просмотре")
+    parser.add_argument('--gzip', dest='gzip_copy', action='store_const', const=True, default=None,
+                        help="записать рядом с каждым HTML файлом сжатую копию .html.gz")
+    parser.add_argument('--chat', dest='chat_numbers', type=int, action='append', metavar='N',
+                        help="экспортировать только чат с номером N (можно указать несколько раз); "
+                             "остальные чаты не декодируются")
+    parser.add_argument('--serve', action='store_true',
+                        help="не создавать HTML, а открыть выгрузку через локальный HTTP-сервер: "
+                             "чаты рендерятся по запросу, оглавление и поиск - через JSON API")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="адрес сервера для --serve")
+    parser.add_argument('--port', type=int, default=8000,
+                        help="порт сервера для --serve (0 - любой свободный)")
+    parser.add_argument('--cache-size', type=int, default=SERVE_CACHE_CHATS, metavar='N',
+                        help="сколько отрендеренных страниц чатов держать в памяти в режиме --serve")
+    parser.add_argument('--incremental', action='store_const', const=True, default=None,
+                        help="рендерить заново только измененные чаты (манифест в output_directory)")
+    parser.add_argument('--no-incremental', dest='incremental', action='store_const', const=False,
+                        help="рендерить все чаты, даже если в config.json включен incremental")
+    args = parser.parse_args(argv)
+    
+    if args.chat_numbers and min(args.chat_numbers) < 1:
+        parser.error("номера чатов (--chat) начинаются с 1")
+    if args.jobs < 0:
+        parser.error("--jobs не может быть отрицательным")
+    if args.serve:
+        if len(args.inputs) > 1:
+            parser.error("--serve открывает один файл выгрузки")
+        if (args.output or args.output_format != 'html' or args.shard_size or args.summary
+                or args.compress_payload or args.gzip_copy or args.chat_numbers or args.incremental
+                or args.profile or args.profile_output):
+            parser.error("--serve не сочетается с параметрами экспорта (-o, -f, --shard-size, --summary, "
+                         "--compress-payload, --gzip, --chat, --incremental, --profile)")
+        if args.cache_size < 0:
+            parser.error("--cache-size не может быть отрицательным")
+    if args.shard_size < 0:
+        parser.error("--shard-size не может быть отрицательным")
+    if args.output_format == 'sqlite' and args.shard_size:
+        parser.error("--shard-size применяется только к формату html")
+    if args.output_format == 'sqlite' and (args.compress_payload or args.gzip_copy):
+        parser.error("--compress-payload и --gzip применяются только к формату html")
+    if args.output_format != 'html' and not args.inputs:
+        parser.error("--format sqlite используется только вместе с входными файлами")
+    if args.output and not args.inputs:
+        parser.error("--output используется только вместе с входными файлами")
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+    
+    return args
+
+def main(argv=None):
+    """Точка входа: пакетный режим для файлов из аргументов, иначе интерактивный"""
+    args = parse_args(argv)
+    
+    if args.serve:
+        json_file = args.inputs[0] if args.inputs else select_json_file()
+        if not json_file:
+            return 1
+        try:
+            return serve(json_file, args.host, args.port, args.jobs, args.search_index,
+                         args.cache_size, args.quiet)
+        except (OSError, ValueError) as e:
+            print(f"❌ {e}", file=sys.stderr)
+            return 1
+    
+    if args.inputs:
+        return run_profiled(
+            lambda: export_batch(args.inputs, args.output, args.output_format, args.jobs,
+                                 args.incremental, args.shard_size, args.quiet, args.summary,
+                                 args.search_index, args.compress_payload, args.gzip_copy,
+                                 args.chat_numbers),
+            args.profile, args.profile_top, args.profile_output)
+    
     print("=" * 70)
     print("🤖 Экспортер чатов DeepSeek в HTML (с аккордеоном для веток)")
     print("=" * 70)
@@ -1561,12 +4864,12 @@ if __name__ == "__main__":
     print("⚠️  Если не видите изменений, используйте принудительную перезагрузку")
     print("-" * 70)
     
-    if len(sys.argv) > 1:
-        input_file = sys.argv[1]
-        if os.path.exists(input_file):
-            print(f"📂 Используется файл из аргументов: {input_file}")
-        else:
-            print(f"❌ Файл не найден: {input_file}")
-            print("Будет предложен выбор файла...")
-    
-    export_with_full_markdown()
+    export_with_full_markdown(jobs=args.jobs, incremental=args.incremental,
+                              shard_size=args.shard_size, profile=args.profile,
+                              profile_top=args.profile_top, profile_output=args.profile_output,
+                              search_index=args.search_index, compress_payload=args.compress_payload,
+                              gzip_copy=args.gzip_copy, chat_numbers=args.chat_numbers)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deepseek_export
+
+
+def make_chat(number):
+    """Чат из вопроса и ответа"""
+    return {
+        'id': f'chat-{number}',
+        'title': f'Чат {number}',
+        'inserted_at': '2024-01-01T10:00:00',
+        'mapping': {
+            'root': {'id': 'root', 'parent': None, 'children': ['1'], 'message': None},
+            '1': {'id': '1', 'parent': 'root', 'children': ['2'],
+                  'message': {'fragments': [{'type': 'REQUEST', 'content': f'Вопрос {number}'}]}},
+            '2': {'id': '2', 'parent': '1', 'children': [],
+                  'message': {'fragments': [{'type': 'RESPONSE', 'content': f'Ответ **{number}**'}]}},
+        },
+    }
+
+
+class BatchIncrementalTest(unittest.TestCase):
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._tmp = tempfile.TemporaryDirectory()
+        os.chdir(self._tmp.name)
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        self._tmp.cleanup()
+
+    def write_export(self, path, chats):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(chats, f, ensure_ascii=False)
+
+    def run_batch(self):
+        summary = os.path.join(self._tmp.name, 'summary.json')
+        code = deepseek_export.export_batch(['acc'], output='out', incremental=True, quiet=True,
+                                            summary_file=summary)
+        self.assertEqual(code, 0)
+        with open(summary, encoding='utf-8') as f:
+            return {os.path.normpath(result['input']): result for result in json.load(f)['results']}
+
+    def test_same_named_inputs_keep_separate_manifests(self):
+        a = os.path.join('acc', 'a', 'conversations.json')
+        b = os.path.join('acc', 'b', 'conversations.json')
+        self.write_export(a, [make_chat(n) for n in range(1, 6)])
+        self.write_export(b, [make_chat(n) for n in range(6, 11)])
+
+        first = self.run_batch()
+        self.assertNotEqual(first[a]['manifest'], first[b]['manifest'])
+        self.assertEqual(first[a]['manifest_misses'], 5)
+
+        second = self.run_batch()
+        for path in (a, b):
+            self.assertEqual(second[path]['manifest_hits'], 5)
+            self.assertEqual(second[path]['manifest_misses'], 0)
+
+    def test_partial_export_keeps_manifest_entries(self):
+        path = os.path.join('acc', 'conversations.json')
+        self.write_export(path, [make_chat(n) for n in range(1, 6)])
+
+        deepseek_export.export_file(path, 'full.html', incremental=True)
+        partial = deepseek_export.export_file(path, 'partial.html', incremental=True, chat_numbers=[3])
+        self.assertEqual(partial['manifest_hits'], 1)
+
+        again = deepseek_export.export_file(path, 'full.html', incremental=True)
+        self.assertEqual(again['manifest_hits'], 5)
+        self.assertEqual(again['manifest_misses'], 0)
+
+    def test_same_named_files_get_separate_outputs(self):
+        a = os.path.join('acc', 'a', 'conversations.json')
+        b = os.path.join('acc', 'b', 'conversations.json')
+        self.write_export(a, [make_chat(1)])
+        self.write_export(b, [make_chat(2)])
+
+        summary = os.path.join(self._tmp.name, 'summary.json')
+        code = deepseek_export.export_batch([a, b], output='out', quiet=True, summary_file=summary)
+        self.assertEqual(code, 0)
+        with open(summary, encoding='utf-8') as f:
+            outputs = [result['output'] for result in json.load(f)['results']]
+        self.assertEqual(len(set(outputs)), 2)
+        self.assertTrue(all(os.path.isfile(output) for output in outputs))
+
+    def test_duplicate_outputs_fail_before_export(self):
+        a = os.path.join('a', 'conversations.json')
+        b = os.path.join('b', 'conversations.json')
+        self.write_export(a, [make_chat(1)])
+        self.write_export(b, [make_chat(2)])
+
+        code = deepseek_export.export_batch(['a', 'b'], output='out', quiet=True)
+        self.assertEqual(code, 1)
+        self.assertFalse(os.path.exists('out'))
+
+
+if __name__ == '__main__':
+    unittest.main()
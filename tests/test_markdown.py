@@ -0,0 +1,26 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deepseek_export
+
+
+class InlineEmphasisTest(unittest.TestCase):
+    def test_inline_emphasis(self):
+        cases = [
+            ('***x***', '<strong><em>x</em></strong>'),
+            ('___x___', '<strong><em>x</em></strong>'),
+            ('a ***жирный курсив*** b', 'a <strong><em>жирный курсив</em></strong> b'),
+            ('**x**', '<strong>x</strong>'),
+            ('*x*', '<em>x</em>'),
+            ('**a *b* c**', '<strong>a <em>b</em> c</strong>'),
+        ]
+        for text, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(deepseek_export.format_inline(text), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
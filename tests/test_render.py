@@ -0,0 +1,75 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deepseek_export
+
+
+def message(node_id, parent, children, fragment_type, content):
+    return {'id': node_id, 'parent': parent, 'children': children,
+            'message': {'fragments': [{'type': fragment_type, 'content': content}]}}
+
+
+# Вопрос и размышление, затем ветка с ответом и ветка со вторым размышлением
+FORKED_CHAT = {
+    'title': 'Ветвление',
+    'mapping': {
+        'root': {'id': 'root', 'parent': None, 'children': ['1'], 'message': None},
+        '1': message('1', 'root', ['2'], 'REQUEST', 'Вопрос'),
+        '2': message('2', '1', ['3', '4'], 'THINK', 'Размышление'),
+        '3': message('3', '2', [], 'THINK', 'Другое размышление'),
+        '4': message('4', '2', ['5'], 'RESPONSE', 'Второй ответ'),
+        '5': message('5', '4', [], 'REQUEST', 'Уточнение'),
+    },
+}
+
+
+class ForkLayoutTest(unittest.TestCase):
+    def tearDown(self):
+        deepseek_export.configure_rendering()
+
+    def test_custom_role_from_role_detection(self):
+        fragment_types = dict(deepseek_export.DEFAULT_ROLE_DETECTION['fragment_types'], THINK='reasoning')
+        deepseek_export.configure_rendering({'fragment_types': fragment_types})
+
+        html = deepseek_export.create_chat_with_accordion(1, FORKED_CHAT, 'fork')
+        self.assertEqual(html.count('class="message '), 5)
+        self.assertIn('class="message reasoning"', html)
+        self.assertIn('<span title="Новых сообщений">📝 1</span>', html)
+        self.assertIn('<span title="Сообщений пользователя">👤 0</span>', html)
+        self.assertIn('<span title="Ответов DeepSeek">🤖 0</span>', html)
+
+    def test_custom_role_is_escaped(self):
+        fragment_types = dict(deepseek_export.DEFAULT_ROLE_DETECTION['fragment_types'], THINK='x" onclick="y')
+        deepseek_export.configure_rendering({'fragment_types': fragment_types})
+
+        html = deepseek_export.create_chat_with_accordion(1, FORKED_CHAT, 'full')
+        self.assertIn('class="message x&quot; onclick=&quot;y"', html)
+        self.assertNotIn('onclick="y"', html)
+
+
+# Идентификаторы узлов с HTML-разметкой
+MARKUP_CHAT = {
+    'title': 'Разметка в id',
+    'mapping': {
+        'root': {'id': 'root', 'parent': None, 'children': ['<q>'], 'message': None},
+        '<q>': message('<q>', 'root', ['<a1>', '<a2>'], 'REQUEST', 'Вопрос'),
+        '<a1>': message('<a1>', '<q>', [], 'RESPONSE', 'Первый ответ'),
+        '<a2>': message('<a2>', '<q>', [], 'RESPONSE', 'Второй ответ'),
+    },
+}
+
+
+class NodeIdEscapingTest(unittest.TestCase):
+    def test_node_ids_are_escaped(self):
+        html = deepseek_export.create_chat_with_accordion(1, MARKUP_CHAT, 'shared')
+        self.assertIn('(узел: &lt;a1&gt;)', html)
+        self.assertIn('(до узла: &lt;q&gt;)', html)
+        self.assertNotIn('<q>', html)
+        self.assertNotIn('<a1>', html)
+
+
+if __name__ == '__main__':
+    unittest.main()
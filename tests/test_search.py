@@ -0,0 +1,60 @@
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deepseek_export
+
+
+def untitled_chat(text):
+    return {'mapping': {
+        'root': {'id': 'root', 'parent': None, 'children': ['1'], 'message': None},
+        '1': {'id': '1', 'parent': 'root', 'children': [],
+              'message': {'fragments': [{'type': 'REQUEST', 'content': text}]}},
+    }}
+
+
+def search_json(chats, jobs):
+    index = deepseek_export.SearchIndex()
+    for i, (_, _, search_data) in enumerate(
+            deepseek_export.iter_rendered_chats(chats, jobs=jobs, chunk_size=1, search=True), 1):
+        index.add_chat(i, search_data)
+    return index.to_json()
+
+
+class SearchIndexTest(unittest.TestCase):
+    def test_untitled_chat_parallel_matches_serial(self):
+        chats = [untitled_chat('Первый вопрос'), untitled_chat('Второй вопрос')]
+        serial = search_json(chats, 1)
+        self.assertIn('"titles":["Чат 1","Чат 2"]', serial)
+        self.assertEqual(search_json(chats, 2), serial)
+
+    def test_spooled_index_matches_in_memory(self):
+        chats = [untitled_chat('Первый вопрос про индекс'), untitled_chat('Второй вопрос')]
+        results = list(deepseek_export.iter_rendered_chats(chats, search=True))
+        memory = deepseek_export.SearchIndex()
+        with deepseek_export.SpooledSearchIndex() as spooled:
+            for i, (_, _, search_data) in enumerate(results, 1):
+                memory.add_chat(i, search_data)
+                spooled.add_chat(i, search_data)
+            self.assertEqual(spooled.to_json(), memory.to_json())
+
+    def test_inline_json_escapes_markup(self):
+        title = '<!--<script> & </script>'
+        index = deepseek_export.SearchIndex()
+        index.add_chat(1, (title, [[1, '1', 'u', title, ['script']]]))
+        out = io.StringIO()
+        index.write(out)
+
+        page = out.getvalue()
+        body = page[page.index('>') + 1:page.rindex('</script>')]
+        self.assertNotIn('<', body)
+        self.assertNotIn('&', body)
+        self.assertEqual(json.loads(body)['titles'], [title])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import deepseek_export
+
+
+class SqliteExportTest(unittest.TestCase):
+    def test_non_scalar_fields_are_stored_as_json(self):
+        chat = {
+            'id': ['chat'],
+            'title': 'Поврежденные поля',
+            'updated_at': {'value': 1},
+            'mapping': {
+                'root': {'id': 'root', 'parent': None, 'children': ['1'], 'message': None},
+                '1': {'id': '1', 'parent': ['root'], 'children': [],
+                      'message': {'model': ['deepseek', 'chat'], 'inserted_at': {'t': 1},
+                                  'fragments': [{'type': 'REQUEST', 'content': 'Вопрос'}]}},
+            },
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            json_file = os.path.join(tmp, 'conversations.json')
+            db_path = os.path.join(tmp, 'export.sqlite')
+            with open(json_file, 'w', encoding='utf-8') as f:
+                json.dump([chat], f, ensure_ascii=False)
+
+            deepseek_export.export_file(json_file, db_path, 'sqlite')
+
+            db = sqlite3.connect(db_path)
+            try:
+                self.assertEqual(db.execute("SELECT chat_id, updated_at FROM chats").fetchone(),
+                                 ('["chat"]', '{"value": 1}'))
+                self.assertEqual(
+                    db.execute("SELECT parent_id, model, inserted_at FROM nodes WHERE node_id = '1'").fetchone(),
+                    ('["root"]', '["deepseek", "chat"]', '{"t": 1}'))
+            finally:
+                db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()